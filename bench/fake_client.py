@@ -0,0 +1,308 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import datetime
+import io
+import math
+import os
+import random
+import struct
+import wave
+from typing import *
+
+from PIL import Image
+
+
+##### / Синтетические медиа / #####
+def make_image(size: int = 1280, format: str = "PNG") -> bytes:
+    out = io.BytesIO()
+    im = Image.effect_mandelbrot((size, size * 3 // 4), (-2, -1.5, 1, 1.5), 100)
+    im.convert("RGBA" if format == "PNG" else "RGB").save(out, format)
+    return out.getvalue()
+
+
+def make_voice(seconds: float = 5.0, rate: int = 16000) -> bytes:
+    out = io.BytesIO()
+    with wave.open(out, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(
+            b"".join(
+                struct.pack("<h", int(8000 * math.sin(2 * math.pi * 440 * i / rate)))
+                for i in range(int(seconds * rate))
+            )
+        )
+    return out.getvalue()
+
+
+##### / Сущности / #####
+class FakePhoto:
+    def __init__(self, photo_id: int):
+        self.photo_id = photo_id
+
+
+class FakeUser:
+    def __init__(self, id: int, first_name: str):
+        self.id = id
+        self.first_name = first_name
+        self.last_name = None
+        self.username = f"user{id}"
+        self.status = None
+        self.photo = FakePhoto(id * 10) if id % 3 else None
+
+
+class FakeChannel:
+    def __init__(self, id: int, title: str):
+        self.id = id
+        self.title = title
+        self.username = None
+        self.photo = FakePhoto(-id * 10) if id % 3 else None
+
+
+class FakeFile:
+    def __init__(self, mime_type: str, name: Optional[str], data: bytes, duration=None):
+        self.mime_type = mime_type
+        self.name = name
+        self.ext = "." + name.rsplit(".", 1)[-1] if name else None
+        self.size = len(data)
+        self.duration = duration
+
+
+class FakeMessage:
+    def __init__(self, client: "FakeClient", chat_id: int, id: int):
+        self._client = client
+        self.chat_id = chat_id
+        self.id = id
+        self.sender = client.users[id % len(client.users)]
+        self.sender_id = self.sender.id
+        self.out = id % 7 == 0
+        self.mentioned = id % 11 == 0
+        self.date = datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=id)
+        self.edit_date = None
+        self.text = f"Сообщение {id} в чате {chat_id} https://t.me/durov 🙂" * (
+            1 + id % 3
+        )
+        self.raw_text = self.text
+        self.reply_to_msg_id = id - 3 if id % 4 == 0 and id > 3 else None
+        self._data = None
+        self.file = None
+        self.media = None
+        if id % 5 == 1:
+            self._data = client.image
+            self.file = FakeFile("image/png", None, self._data)
+        elif id % 5 == 2:
+            self._data = client.voice
+            self.file = FakeFile("audio/x-wav", "voice.wav", self._data, duration=5)
+        elif id % 5 == 3:
+            self._data = client.blob
+            self.file = FakeFile(
+                "application/octet-stream", f"file{id}.bin", self._data
+            )
+        if self.file:
+            self.media = self
+        self.photo = self.file if id % 5 == 1 else None
+        self.voice = self.file if id % 5 == 2 else None
+        self.audio = None
+        self.sticker = None
+        self.document = None
+
+    async def get_reply_message(self):
+        if self.reply_to_msg_id is None:
+            return None
+        await self._client.rpc()
+        return FakeMessage(self._client, self.chat_id, self.reply_to_msg_id)
+
+    async def download_media(self, file=None, progress_callback=None, **kwargs):
+        await self._client.rpc(len(self._data or b""))
+        if progress_callback:
+            progress_callback(len(self._data), len(self._data))
+        if file is bytes:
+            return self._data
+        with open(file, "wb") as f:
+            f.write(self._data)
+        return file
+
+    async def edit(self, text):
+        await self._client.rpc()
+        self.text = text
+        return self
+
+    async def delete(self):
+        await self._client.rpc()
+
+
+class FakeDialog:
+    def __init__(self, entity, unread: int, message: FakeMessage):
+        self.entity = entity
+        self.id = entity.id
+        self.title = getattr(entity, "title", None) or entity.first_name
+        self.name = self.title
+        self.unread_count = unread
+        self.message = message
+        self.date = message.date
+        self.is_user = isinstance(entity, FakeUser)
+        self.is_group = not self.is_user and entity.id % 2 == 0
+        self.is_channel = not self.is_user
+        self.archived = False
+        self.pinned = False
+        self.unread_mentions_count = 0
+
+
+##### / Клиент / #####
+class FakeClient:
+    """Локальная замена TelegramClient для бенчмарков.
+
+    Отдаёт синтетические диалоги, сообщения с реплаями и медиа. Каждый
+    "запрос к Telegram" ждёт `latency` секунд (± `jitter`) плюс время
+    передачи медиа со скоростью `bandwidth` байт/с.
+    """
+
+    def __init__(
+        self,
+        dialogs: int = 200,
+        messages: int = 1000,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        bandwidth: float = 2 * 1024 * 1024,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.messages = messages
+        self.parse_mode = "html"
+        self.flood_sleep_threshold = 60
+        self.rpc_count = 0
+        self.users = [FakeUser(1000 + i, f"Юзер {i}") for i in range(50)]
+        self.chats = {
+            -(100 + i) if i % 2 else 1000 + i: (
+                FakeChannel(-(100 + i), f"Группа {i}")
+                if i % 2
+                else FakeUser(1000 + i, f"Юзер {i}")
+            )
+            for i in range(dialogs)
+        }
+        self.image = make_image()
+        self.voice = make_voice()
+        self.blob = os.urandom(256 * 1024)
+        self.avatar = make_image(640, "JPEG")
+
+    async def rpc(self, size: int = 0):
+        self.rpc_count += 1
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        await asyncio.sleep(max(delay, 0) + size / self.bandwidth)
+
+    ##### / Подключение / #####
+    def is_connected(self):
+        return True
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def is_user_authorized(self):
+        return True
+
+    async def get_me(self):
+        return self.users[0]
+
+    def add_event_handler(self, *args, **kwargs):
+        pass
+
+    def on(self, *args, **kwargs):
+        return lambda f: f
+
+    ##### / Запросы / #####
+    async def get_dialogs(self, limit=None, offset_peer=None, archived=None, **kwargs):
+        await self.rpc()
+        dialogs = []
+        for i, entity in enumerate(self.chats.values()):
+            dialog = FakeDialog(
+                entity, i % 4, FakeMessage(self, entity.id, self.messages)
+            )
+            dialog.archived = i % 10 == 9
+            dialog.pinned = i < 2
+            if archived is None or dialog.archived == archived:
+                dialogs.append(dialog)
+        if offset_peer is not None:
+            ids = [d.id for d in dialogs]
+            dialogs = dialogs[ids.index(offset_peer) + 1 :]
+        return dialogs[:limit]
+
+    async def get_entity(self, id):
+        await self.rpc()
+        if id in self.chats:
+            return self.chats[id]
+        for u in self.users:
+            if u.id == id:
+                return u
+        raise ValueError(f"Could not find the input entity for {id}")
+
+    def conversation(self, chat):
+        client = self
+
+        class _Conversation:
+            async def mark_read(self):
+                await client.rpc()
+
+        return _Conversation()
+
+    async def send_read_acknowledge(self, *args, **kwargs):
+        await self.rpc()
+
+    async def edit_message(self, entity, message, text=None, **kwargs):
+        await self.rpc()
+        return FakeMessage(self, entity, message)
+
+    async def delete_messages(self, entity, message_ids, **kwargs):
+        await self.rpc()
+        return []
+
+    async def forward_messages(self, entity, messages, from_peer=None, **kwargs):
+        await self.rpc()
+        return []
+
+    async def get_messages(self, entity, limit=None, add_offset=0, ids=None, **kwargs):
+        await self.rpc()
+        if ids is not None:
+            if isinstance(ids, list):
+                return [
+                    FakeMessage(self, entity, i) for i in ids if 0 < i <= self.messages
+                ]
+            return FakeMessage(self, entity, ids) if 0 < ids <= self.messages else None
+        top = kwargs.get("offset_id") or self.messages + 1
+        start = top - 1 - add_offset
+        min_id = kwargs.get("min_id") or 0
+        if search := kwargs.get("search"):
+            # поиск: совпадает каждое десятое сообщение, глобальный - по первому чату
+            entity = entity if entity is not None else next(iter(self.chats))
+            ids = [i for i in range(start, max(min_id, 0), -1) if i % 10 == 0]
+            return [FakeMessage(self, entity, i) for i in ids[: limit or 20]]
+        return [
+            FakeMessage(self, entity, i)
+            for i in range(start, max(start - (limit or 20), min_id, 0), -1)
+        ]
+
+    async def iter_download(self, media, **kwargs):
+        data = media._data
+        for i in range(0, len(data), 128 * 1024):
+            chunk = data[i : i + 128 * 1024]
+            await self.rpc(len(chunk))
+            yield chunk
+
+    async def download_profile_photo(self, entity, file=None, **kwargs):
+        await self.rpc(len(self.avatar))
+        return self.avatar
+
+    async def send_message(self, *args, **kwargs):
+        await self.rpc()
+
+    async def send_file(self, *args, **kwargs):
+        await self.rpc()
+
+    async def __call__(self, request, *args, **kwargs):
+        await self.rpc()
+        raise NotImplementedError(type(request).__name__)
@@ -0,0 +1,229 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+"""Нагрузочный бенчмарк эндпоинтов на фейковом клиенте Telegram.
+
+    python bench/run.py --concurrency 20 --requests 500 --latency 0.05
+
+Приложение поднимается в отдельной временной папке (свои cache/ и
+session/), вместо TelegramClient подставляется `FakeClient`, запросы
+идут напрямую в ASGI-приложение без сети.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import *
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "tapkofon"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+ROUTES = {
+    "index": "/",
+    "chat": "/chat/{chat}",
+    "download": "/chat/{chat}/download/{msg}",
+    "avatar": "/user/{user}/avatar",
+    "recognize": "/chat/{chat}/recognize/{voice}",
+}
+
+
+##### / Мини ASGI-клиент / #####
+async def request(app, path: str) -> Tuple[int, bytes]:
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"host", b"bench"), (b"cookie", b"access_token=bench")],
+        "client": ("127.0.0.1", 0),
+        "server": ("bench", 80),
+    }
+    status, body, sent = 0, [], False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, b"".join(body)
+
+
+class Lifespan:
+    def __init__(self, app):
+        self.app = app
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    async def _event(self, event: str):
+        done = asyncio.get_event_loop().create_future()
+
+        async def send(message):
+            if not done.done():
+                done.set_result(message)
+
+        self._send = send
+        await self.queue.put({"type": f"lifespan.{event}"})
+        if self.task is None:
+            self.task = asyncio.ensure_future(
+                self.app({"type": "lifespan"}, self.queue.get, lambda m: self._send(m))
+            )
+        await done
+
+    async def __aenter__(self):
+        await self._event("startup")
+
+    async def __aexit__(self, *exc):
+        await self._event("shutdown")
+        await self.task
+
+
+##### / Бенчмарк / #####
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0.0
+
+
+async def bench(args) -> Dict[str, Any]:
+    import speech_recognition as sr
+    from fake_client import FakeClient
+
+    import main
+
+    client = FakeClient(
+        dialogs=args.dialogs, messages=args.messages, latency=args.latency
+    )
+    main.accounts.client_factory = lambda account: client
+    main.config.passwd = ""
+
+    def fake_recognize(self, audio_data, language=None, **kwargs):
+        time.sleep(args.recognize_latency)
+        return "распознанный текст"
+
+    sr.Recognizer.recognize_google = fake_recognize
+
+    chats = list(client.chats)
+    counter = itertools.count()
+
+    def next_path(route: str) -> str:
+        i = next(counter)
+        # у сообщений с id % 5 = 1, 2, 3 есть медиа (фото, войс, документ)
+        block = 5 * (i % (args.messages // 5))
+        return ROUTES[route].format(
+            chat=chats[i % len(chats)],
+            msg=block + 1 + i % 3,
+            voice=block + 2,
+            user=client.users[i % len(client.users)].id,
+        )
+
+    async with Lifespan(main.app):
+        return await run_routes(args, main.app, client, next_path)
+
+
+async def run_routes(args, app, client, next_path) -> Dict[str, Any]:
+    results = {}
+    for route in args.routes:
+        latencies, errors = [], 0
+        remaining = itertools.count()
+
+        async def worker():
+            nonlocal errors
+            while next(remaining) < args.requests:
+                path = next_path(route)
+                start = time.perf_counter()
+                try:
+                    status, body = await request(app, path)
+                except Exception as ex:
+                    print(f"{path}: {ex!r}", file=sys.stderr)
+                    status, body = 500, b""
+                latencies.append(time.perf_counter() - start)
+                if status >= 400 or "АХТУНГ".encode() in body:
+                    errors += 1
+
+        rpc_before = client.rpc_count
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        results[route] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "rps": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+            "rpc_per_request": round(
+                (client.rpc_count - rpc_before) / max(len(latencies), 1), 2
+            ),
+        }
+    results["peak_rss_mb"] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+    )
+    return results
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200, help="на каждый роут")
+    parser.add_argument("--latency", type=float, default=0.05, help="RPC, секунды")
+    parser.add_argument("--recognize-latency", type=float, default=0.2)
+    parser.add_argument("--dialogs", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument(
+        "--routes", nargs="+", default=list(ROUTES), choices=list(ROUTES)
+    )
+    parser.add_argument("--json", action="store_true", help="вывод в JSON")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="tapkofon-bench-"))
+    try:
+        (workdir / "session").mkdir()
+        (workdir / "app").mkdir()
+        os.symlink(ROOT / "tapkofon" / "templates", workdir / "app" / "templates")
+        os.chdir(workdir / "app")
+        results = asyncio.get_event_loop().run_until_complete(bench(args))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    print(
+        f"{'route':<10} {'req':>6} {'err':>5} {'rps':>8} {'p50ms':>8} {'p99ms':>8} {'rpc/req':>8}"
+    )
+    for route in args.routes:
+        r = results[route]
+        print(
+            f"{route:<10} {r['requests']:>6} {r['errors']:>5} {r['rps']:>8} "
+            f"{r['p50_ms']:>8} {r['p99_ms']:>8} {r['rpc_per_request']:>8}"
+        )
+    print(f"peak RSS: {results['peak_rss_mb']} MB")
+
+
+if __name__ == "__main__":
+    main_()
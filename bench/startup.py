@@ -0,0 +1,126 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+"""Бенчмарк холодного старта: импорт main, startup и первые запросы.
+
+    python bench/startup.py --runs 5 --max-import-ms 800
+
+Каждый прогон - отдельный процесс со своей временной папкой, так что
+кеш модулей не помогает. Падает с кодом 1, если превышены пороги или при
+импорте подгрузились модули, которые должны грузиться лениво.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import *
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Нужны только отдельным эндпоинтам и не должны грузиться при старте
+LAZY_MODULES = ("speech_recognition", "pydub", "emoji")
+
+
+##### / Замер в дочернем процессе / #####
+async def _first_requests(main) -> Dict[str, float]:
+    from fake_client import FakeClient
+    from run import Lifespan, request
+
+    client = FakeClient(dialogs=50, messages=200, latency=0)
+    main.accounts.client_factory = lambda account: client
+    main.config.passwd = ""
+    result = {}
+    start = time.perf_counter()
+    async with Lifespan(main.app):
+        result["startup_ms"] = (time.perf_counter() - start) * 1000
+        for name, path in (
+            ("about", "/about"),
+            ("chat", f"/chat/{next(iter(client.chats))}"),
+        ):
+            start = time.perf_counter()
+            status, _ = await request(main.app, path)
+            if status != 200:
+                raise RuntimeError(f"{path}: HTTP {status}")
+            result[f"first_{name}_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def child():
+    sys.path.insert(0, str(ROOT / "tapkofon"))
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    start = time.perf_counter()
+    import main
+
+    result = {"import_ms": (time.perf_counter() - start) * 1000}
+    result["eager"] = [m for m in LAZY_MODULES if m in sys.modules]
+    result.update(asyncio.get_event_loop().run_until_complete(_first_requests(main)))
+    print(json.dumps(result))
+
+
+##### / Прогоны / #####
+def run_once() -> Dict[str, Any]:
+    workdir = Path(tempfile.mkdtemp(prefix="tapkofon-startup-"))
+    try:
+        (workdir / "session").mkdir()
+        (workdir / "app").mkdir()
+        os.symlink(ROOT / "tapkofon" / "templates", workdir / "app" / "templates")
+        out = subprocess.run(
+            [sys.executable, "-W", "ignore", __file__, "--child"],
+            cwd=workdir / "app",
+            capture_output=True,
+            text=True,
+        )
+        if out.returncode:
+            sys.exit(out.stderr)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, help="порог медианы импорта")
+    parser.add_argument(
+        "--max-first-ms", type=float, help="порог медианы первого запроса чата"
+    )
+    parser.add_argument("--json", action="store_true", help="вывод в JSON")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child()
+
+    runs = [run_once() for _ in range(args.runs)]
+    keys = ("import_ms", "startup_ms", "first_about_ms", "first_chat_ms")
+    results = {k: round(statistics.median(r[k] for r in runs), 1) for k in keys}
+    results["eager"] = sorted({m for r in runs for m in r["eager"]})
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        for k in keys:
+            print(f"{k:<16} {results[k]:>8}")
+        print(f"{'eager modules':<16} {', '.join(results['eager']) or '-'}")
+
+    failed = []
+    if results["eager"]:
+        failed.append(f"при импорте загружены: {', '.join(results['eager'])}")
+    if args.max_import_ms and results["import_ms"] > args.max_import_ms:
+        failed.append(f"импорт {results['import_ms']} мс > {args.max_import_ms}")
+    if args.max_first_ms and results["first_chat_ms"] > args.max_first_ms:
+        failed.append(f"первый чат {results['first_chat_ms']} мс > {args.max_first_ms}")
+    for msg in failed:
+        print(f"FAIL: {msg}", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main_()
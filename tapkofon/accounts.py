@@ -0,0 +1,282 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+"""Несколько аккаунтов Telegram в одном процессе.
+
+Аккаунт запроса выбирается по куке доступа и хранится в contextvar, а
+модульные `user`, `scheduler`, `history`, `media` и `updates` в main -
+прокси к аккаунту текущего запроса. Клиент, планировщик и база создаются
+при первом обращении; дополнительные аккаунты освобождаются после
+`idle_timeout` без запросов, задач и открытых ответов.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import time
+from pathlib import Path
+from typing import *
+
+import bus
+import fastdl
+import mediacache
+import metrics
+import rpc
+import store
+
+DEFAULT = "default"
+
+_current: "contextvars.ContextVar[Optional[Account]]" = contextvars.ContextVar(
+    "account", default=None
+)
+
+
+class Account:
+    def __init__(self, owner: "Accounts", name: str, folder: Path, cache: str):
+        self.owner = owner
+        self.name = name
+        self.folder = folder
+        self.cache = cache
+        self.updates = bus.EventBus()
+        # версия списка чатов для ETag
+        self.dialogs_version = 0
+        self.used = time.monotonic()
+        # запросы, ответы и задачи, которые сейчас работают с аккаунтом
+        self.busy = 0
+        self._client = None
+        self._scheduler: Optional[rpc.Scheduler] = None
+        self._downloader: Optional[fastdl.Downloader] = None
+        self._history: Optional[store.MessageStore] = None
+        self._media: Optional[mediacache.MediaCache] = None
+
+    @property
+    def token(self) -> str:
+        return self.owner.token(self.name)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            self._client = self.owner.client_factory(self)
+            for event, handler in self.owner.handlers:
+                self._client.add_event_handler(self._bind(handler), event)
+        return self._client
+
+    @property
+    def scheduler(self) -> rpc.Scheduler:
+        if self._scheduler is None:
+            self._scheduler = rpc.Scheduler(
+                self.client,
+                self.owner.config.rpc_limits,
+                # FloodWait выше порога - пауза класса, а не сон запроса страницы
+                flood_sleep_threshold=self.owner.config.flood_sleep_threshold,
+            )
+        return self._scheduler
+
+    @property
+    def downloader(self) -> fastdl.Downloader:
+        if self._downloader is None:
+            self._downloader = fastdl.Downloader(
+                self.client,
+                self.scheduler,
+                connections=self.owner.config.download_connections,
+            )
+        return self._downloader
+
+    @property
+    def history(self) -> store.MessageStore:
+        if self._history is None:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            self._history = store.MessageStore(self.folder / "messages.db")
+            # событий до этого момента не было - перед показом чаты сверятся
+            asyncio.ensure_future(self._history.stale())
+        return self._history
+
+    @property
+    def media(self) -> mediacache.MediaCache:
+        if self._media is None:
+            config = self.owner.config
+            self._media = mediacache.MediaCache(
+                self.cache,
+                hot_bytes=config.hot_cache_mb * 1024 * 1024,
+                hot_item=config.hot_cache_item_kb * 1024,
+            )
+            self._media.sweep()
+        return self._media
+
+    def touch(self):
+        self.used = time.monotonic()
+
+    @contextlib.contextmanager
+    def lease(self):
+        """Аккаунт занят и не освобождается по простою"""
+        self.busy += 1
+        try:
+            yield self
+        finally:
+            self.busy -= 1
+            self.touch()
+
+    def _bind(self, handler: Callable[[Any], Awaitable[Any]]):
+        async def run(event):
+            with self.owner.use(self), self.lease():
+                await handler(event)
+
+        return run
+
+    async def release(self):
+        """Отключает клиента и освобождает всё, что создаётся заново при обращении"""
+        client, history = self._client, self._history
+        self._client = self._scheduler = self._downloader = self._history = None
+        if self._media is not None:
+            self._media.reset()
+        if client is not None:
+            with contextlib.suppress(Exception):
+                await client.disconnect()
+        if history is not None:
+            await history.stale()
+            await history.close()
+
+
+class Accounts:
+    """Реестр аккаунтов: основной плюс описанные в `config.accounts`.
+
+    Основной живёт в `session/` и `cache/`, как и раньше, остальные - в
+    `session/accounts/{имя}/` и `cache-{имя}/`.
+    """
+
+    def __init__(self, config, root: Path):
+        self.config = config
+        self.root = root
+        self.accounts: Dict[str, Account] = {}
+        self.handlers: List[Tuple[Any, Callable]] = []
+        self.client_factory: Callable[[Account], Any] = self._new_client
+
+    def _new_client(self, account: Account):
+        client = metrics.InstrumentedClient(
+            str(account.folder / "session"), self.config.api_id, self.config.api_hash
+        )
+        client.parse_mode = "html"
+        return client
+
+    def get(self, name: str = DEFAULT) -> Account:
+        if name != DEFAULT and name not in self.config.accounts:
+            raise KeyError(f"Unknown account: {name}")
+        if (account := self.accounts.get(name)) is None:
+            if name == DEFAULT:
+                account = Account(self, name, self.root, "cache")
+            else:
+                account = Account(
+                    self, name, self.root / "accounts" / name, f"cache-{name}"
+                )
+            self.accounts[name] = account
+        return account
+
+    @property
+    def default(self) -> Account:
+        return self.get(DEFAULT)
+
+    def current(self) -> Account:
+        return _current.get() or self.default
+
+    @contextlib.contextmanager
+    def use(self, account: Union[Account, str, None]):
+        if not isinstance(account, Account):
+            account = self.get(account or DEFAULT)
+        token = _current.set(account)
+        try:
+            yield account
+        finally:
+            _current.reset(token)
+
+    def activate(self, account: Account):
+        """Аккаунт до конца текущей задачи (запроса)"""
+        _current.set(account)
+        account.touch()
+
+    ##### / Доступ / #####
+    def token(self, name: str) -> str:
+        if name == DEFAULT:
+            return self.config.access_cookie
+        return hashlib.sha256(
+            f"{self.config.access_cookie}:{name}".encode()
+        ).hexdigest()
+
+    def by_token(self, token: Optional[str]) -> Optional[Account]:
+        if not token:
+            return None
+        for name in (DEFAULT, *self.config.accounts):
+            if token == self.token(name):
+                return self.get(name)
+        return None
+
+    def by_password(self, password: Optional[str]) -> Optional[Account]:
+        if not password:
+            return None
+        if password == self.config.passwd:
+            return self.default
+        for name, secret in self.config.accounts.items():
+            if secret and password == secret:
+                return self.get(name)
+        return None
+
+    ##### / События и прокси / #####
+    def on(self, event):
+        """Как `client.on`, но для клиентов всех аккаунтов, в том числе будущих"""
+
+        def decorator(handler):
+            self.handlers.append((event, handler))
+            for account in self.accounts.values():
+                if account._client is not None:
+                    account._client.add_event_handler(account._bind(handler), event)
+            return handler
+
+        return decorator
+
+    def proxy(self, attr: str) -> "Current":
+        return Current(self, attr)
+
+    def busy(self, app):
+        """ASGI-обёртка: аккаунт запроса занят, пока ответ не отдан целиком"""
+
+        async def run(scope, receive, send):
+            if scope["type"] != "http":
+                return await app(scope, receive, send)
+            with self.current().lease():
+                await app(scope, receive, send)
+
+        return run
+
+    ##### / Простой / #####
+    async def release_idle(self, timeout: float) -> int:
+        # основной аккаунт держит обработку обновлений и предзагрузку
+        now = time.monotonic()
+        idle = [
+            a
+            for a in self.accounts.values()
+            if a.name != DEFAULT
+            and a._client is not None
+            and not a.busy
+            and now - a.used > timeout
+        ]
+        for account in idle:
+            await account.release()
+        return len(idle)
+
+    async def watch_idle(self, timeout: float):
+        while True:
+            await asyncio.sleep(min(timeout, 60))
+            with contextlib.suppress(Exception):
+                await self.release_idle(timeout)
+
+
+class Current:
+    """Атрибут аккаунта текущего запроса - клиент, планировщик, база..."""
+
+    def __init__(self, owner: Accounts, attr: str):
+        self._owner = owner
+        self._attr = attr
+
+    def __getattr__(self, name: str):
+        return getattr(getattr(self._owner.current(), self._attr), name)
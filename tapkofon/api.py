@@ -0,0 +1,78 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+"""Общее для JSON API: сериализация, выбор полей и конверт страниц.
+
+Поля выбираются параметром `fields` через запятую, вложенные - через
+точку: `?fields=id,text,sender.id`. Без него отдаётся модель целиком,
+пустые (None) поля не выводятся.
+"""
+
+import json
+from typing import *
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него - стандартный json
+    orjson = None
+
+
+##### / Ответы / #####
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def error(message: str, status_code: int = 400) -> FastJSONResponse:
+    return FastJSONResponse({"error": message}, status_code=status_code)
+
+
+##### / Выбор полей / #####
+Fields = Optional[Dict[str, "Fields"]]
+
+
+def parse_fields(fields: Optional[str]) -> Fields:
+    if not fields:
+        return None
+    tree = {}
+    for path in fields.split(","):
+        node = tree
+        for part in path.strip().split("."):
+            if part:
+                node = node.setdefault(part, {})
+    return tree or None
+
+
+def wants(tree: Fields, name: str) -> bool:
+    """Нужно ли поле верхнего уровня - чтобы не делать лишних запросов"""
+    return tree is None or name in tree
+
+
+def select(data: Any, tree: Fields) -> Any:
+    if not tree:
+        return data
+    if isinstance(data, list):
+        return [select(item, tree) for item in data]
+    if isinstance(data, dict):
+        return {k: select(data[k], sub) for k, sub in tree.items() if k in data}
+    return data
+
+
+def item(model: BaseModel, tree: Fields) -> FastJSONResponse:
+    return FastJSONResponse(select(model.model_dump(exclude_none=True), tree))
+
+
+def page(
+    items: List[BaseModel], next_cursor: Optional[str], tree: Fields
+) -> FastJSONResponse:
+    return FastJSONResponse(
+        {
+            "items": select([i.model_dump(exclude_none=True) for i in items], tree),
+            "next": next_cursor,
+        }
+    )
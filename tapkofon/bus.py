@@ -0,0 +1,47 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import contextlib
+from typing import *
+
+
+class EventBus:
+    """Внутрипроцессная шина событий для long-poll.
+
+    Подписчик сначала подписывается на тему, затем проверяет данные и только
+    потом ждёт - так событие между проверкой и ожиданием не теряется.
+    """
+
+    def __init__(self):
+        self._waiters: Dict[Hashable, Set[asyncio.Future]] = {}
+
+    def publish(self, topic: Hashable, value: Any = None):
+        for fut in self._waiters.pop(topic, ()):
+            if not fut.done():
+                fut.set_result(value)
+
+    @contextlib.contextmanager
+    def subscribe(self, topic: Hashable) -> Iterator[asyncio.Future]:
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(topic, set()).add(fut)
+        try:
+            yield fut
+        finally:
+            if (waiters := self._waiters.get(topic)) is not None:
+                waiters.discard(fut)
+                if not waiters:
+                    del self._waiters[topic]
+
+    @staticmethod
+    async def wait(fut: asyncio.Future, timeout: float) -> bool:
+        """Ждёт событие не дольше `timeout`; False - если его не было"""
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    @property
+    def listeners(self) -> int:
+        return sum(len(w) for w in self._waiters.values())
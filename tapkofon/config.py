@@ -1,6 +1,7 @@
 # Copyright 2022 d4n13l3k00.
 # SPDX-License-Identifier: 	AGPL-3.0-or-later
 from pathlib import Path
+from typing import *
 
 import toml
 
@@ -16,13 +17,61 @@ class Config:
             "pic_max_size": 256,
             "pic_format": "jpeg",
             "pic_avatar_max_size": 256,
+            "sticker_size": 96,
             "msg_regex_tme": True,
             "msg_replace_regex": r"(https?://)?t\.me/(?P<chat>[A-Za-z0-9-_]{3,20})/?\d*",
             "msg_regex_to": r"/chat/\g<chat>",
             "recognize_lang": "ru-RU",
+            "recognize_chunk_s": 30,
+            "recognize_workers": 4,
+            "audio_format": "mp3",
+            "audio_bitrate": "32k",
+            "video_format": "3gp",
+            "video_max_size": 176,
+            "video_bitrate": "96k",
+            "video_fps": 15,
+            "jobs_workers": 2,
+            "jobs_io_workers": 4,
+            "jobs_wait": 20,
+            "download_connections": 4,
+            "download_parallel_mb": 10,
+            "cache_page_size": 50,
+            "server_timing": True,
+            "profile_enabled": False,
+            "profile_threshold_ms": 1000,
+            "profile_interval_ms": 5,
+            "flood_sleep_threshold": 0,
+            "store_backfill": 50,
+            "search_page_size": 20,
+            "poll_timeout": 25,
+            "minify_html": True,
+            "compress_min_size": 512,
+            "etag_max_age": 60,
+            "dialogs_page_size": 30,
+            "dialogs_scan_limit": 300,
+            "avatar_sprite_size": 32,
+            "account_idle_timeout": 900,
+            "hot_cache_mb": 32,
+            "hot_cache_item_kb": 512,
+            "prefetch_enabled": False,
+            # id чатов для предзагрузки, пустой список - все чаты
+            "prefetch_chats": [],
+            "prefetch_max_mb": 5,
+            "prefetch_mb_per_hour": 100,
+            "prefetch_pending": 4,
+            # дополнительные аккаунты: имя -> код-пароль для входа в него
+            "accounts": {},
+            # класс методов: [запросов в секунду, запас]
+            "rpc_limits": {
+                "messages": [5, 10],
+                "entity": [5, 10],
+                "dialogs": [1, 3],
+                "files": [10, 20],
+                "other": [5, 10],
+            },
         }
 
-        self.config = self.default_config
+        self.config = dict(self.default_config)
         try:
             with self.config_path.open("r") as f:
                 self.config.update(toml.load(f))
@@ -35,3 +84,14 @@ class Config:
                 setattr(self, key, value)
             else:
                 raise KeyError(f"Unknown key: {key}")
+
+
+_config: Optional[Config] = None
+
+
+def load() -> Config:
+    """Один объект конфига на процесс: файл читается только при первом вызове"""
+    global _config
+    if _config is None:
+        _config = Config()
+    return _config
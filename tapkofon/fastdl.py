@@ -0,0 +1,191 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+"""Параллельная загрузка больших файлов (по мотивам FastTelethon).
+
+`download_media` тянет файл частями по одному соединению, друг за другом.
+Здесь части запрашиваются одновременно через несколько отдельных
+MTProto-соединений к DC файла и пишутся в файл по своим смещениям, так что
+скорость растёт с числом соединений.
+"""
+
+import asyncio
+import contextlib
+import os
+from typing import *
+
+import rpc
+from telethon import errors, functions, utils
+from telethon.crypto import AuthKey
+from telethon.network import MTProtoSender
+from telethon.tl.alltlobjects import LAYER
+
+# максимум, который отдаёт upload.getFile за один запрос
+PART_SIZE = 512 * 1024
+
+
+class Downloader:
+    """Параллельные загрузки одного клиента.
+
+    Ключ авторизации для чужого DC получается один раз (рукопожатие и
+    импорт экспортированной авторизации на первом соединении), остальные
+    соединения и последующие загрузки используют его же. В своём DC хватает
+    ключа сессии. Экспорт идёт через планировщик, части - через `_call`
+    клиента, так что FloodWait и метрики учитываются как у прочих запросов.
+    """
+
+    def __init__(
+        self,
+        client,
+        scheduler: rpc.Scheduler,
+        connections: int = 4,
+        part_size: int = PART_SIZE,
+    ):
+        self.client = client
+        self.scheduler = scheduler
+        self.connections = connections
+        self.part_size = part_size
+        self._keys: Dict[int, AuthKey] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    async def _sender(self, dc_id: int, key: Optional[AuthKey]) -> MTProtoSender:
+        # у каждого соединения своя копия ключа: сброс в одном не трогает другие
+        dc = await self.client._get_dc(dc_id)
+        sender = MTProtoSender(key and AuthKey(key.key), loggers=self.client._log)
+        await sender.connect(
+            self.client._connection(
+                dc.ip_address,
+                dc.port,
+                dc.id,
+                loggers=self.client._log,
+                proxy=self.client._proxy,
+                local_addr=self.client._local_addr,
+            )
+        )
+        return sender
+
+    async def _key(self, dc_id: int) -> Tuple[AuthKey, Optional[MTProtoSender]]:
+        """Ключ для DC и соединение, на котором он только что получен (если так)"""
+        if dc_id == self.client.session.dc_id:
+            return self.client.session.auth_key, None
+        async with self._locks.setdefault(dc_id, asyncio.Lock()):
+            if key := self._keys.get(dc_id):
+                return key, None
+            sender = await self._sender(dc_id, None)
+            try:
+                auth = await self.scheduler.call(
+                    "auth",
+                    ("ExportAuthorizationRequest", dc_id),
+                    lambda: self.client(
+                        functions.auth.ExportAuthorizationRequest(dc_id)
+                    ),
+                    remember=False,
+                )
+                self.client._init_request.query = (
+                    functions.auth.ImportAuthorizationRequest(
+                        id=auth.id, bytes=auth.bytes
+                    )
+                )
+                await sender.send(
+                    functions.InvokeWithLayerRequest(LAYER, self.client._init_request)
+                )
+            except BaseException:
+                await sender.disconnect()
+                raise
+            self._keys[dc_id] = sender.auth_key
+            return sender.auth_key, sender
+
+    async def _part(self, sender: MTProtoSender, location, offset: int) -> bytes:
+        while True:
+            try:
+                result = await self.client._call(
+                    sender,
+                    functions.upload.GetFileRequest(
+                        location, offset=offset, limit=self.part_size
+                    ),
+                )
+                return result.bytes
+            except errors.FloodWaitError as e:
+                await asyncio.sleep(e.seconds)
+
+    async def _download(
+        self,
+        dc_id: int,
+        location,
+        size: int,
+        file: str,
+        progress_callback: Optional[Callable[[int, int], Any]],
+    ):
+        parts = -(-size // self.part_size)
+        key, first = await self._key(dc_id)
+        count = max(min(self.connections, parts), 1) - (first is not None)
+        senders = [s for s in [first] if s is not None]
+        try:
+            connected = await asyncio.gather(
+                *(self._sender(dc_id, key) for _ in range(count)),
+                return_exceptions=True,
+            )
+            # подключившиеся попадают в senders и закрываются в finally
+            senders += [s for s in connected if not isinstance(s, BaseException)]
+            for result in connected:
+                if isinstance(result, BaseException):
+                    raise result
+            pending = iter(range(parts))
+            done = 0
+            with open(f"{file}.part", "wb") as f:
+                f.truncate(size)
+
+                async def worker(sender: MTProtoSender):
+                    nonlocal done
+                    # части разбираются из общего итератора, пока не кончатся
+                    for part in pending:
+                        data = await self._part(sender, location, part * self.part_size)
+                        f.seek(part * self.part_size)
+                        f.write(data)
+                        done += len(data)
+                        if progress_callback:
+                            progress_callback(done, size)
+
+                tasks = [asyncio.ensure_future(worker(s)) for s in senders]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    # остальные не должны писать в уже закрытый файл
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+            os.replace(f"{file}.part", file)
+        except (errors.AuthKeyUnregisteredError, errors.AuthKeyInvalidError):
+            # ключ отозван - в следующий раз получим новый
+            self._keys.pop(dc_id, None)
+            raise
+        finally:
+            for sender in senders:
+                with contextlib.suppress(Exception):
+                    await sender.disconnect()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(f"{file}.part")
+
+    async def download(
+        self,
+        document,
+        file: str,
+        progress_callback: Optional[Callable[[int, int], Any]] = None,
+    ) -> str:
+        """Скачивает документ в `file` через `connections` соединений.
+
+        Пишет сначала в `file.part` и переименовывает по готовности, чтобы кеш
+        не отдал недокачанный файл. Возвращает путь к файлу.
+        """
+        dc_id, location = utils.get_input_location(document)
+        try:
+            await self._download(
+                dc_id, location, document.size, file, progress_callback
+            )
+        except errors.FileMigrateError as e:
+            # файл живёт в другом DC - качаем оттуда заново
+            await self._download(
+                e.new_dc, location, document.size, file, progress_callback
+            )
+        return file
@@ -0,0 +1,213 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import time
+import traceback
+from collections import OrderedDict
+from enum import IntEnum
+from pathlib import Path
+from typing import *
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # пользователь ждёт ответа
+    PREFETCH = 1  # фоновая подготовка медиа
+    RECOGNIZE = 2  # распознавание речи
+
+
+class Job:
+    def __init__(self, kind: str, key: str, priority: int, args: Dict[str, Any]):
+        self.kind = kind
+        self.key = key
+        self.priority = priority
+        self.args = args
+        self.state = "queued"
+        self.stage = "В очереди"
+        self.progress = 0.0
+        self.result: Any = None
+        # готовая часть результата, пока задача идёт
+        self.partial: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.waiter: Optional[asyncio.Future] = None
+        self.future: asyncio.Future = asyncio.get_event_loop().create_future()
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("done", "error")
+
+    def dump(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "key": self.key,
+            "priority": int(self.priority),
+            "args": self.args,
+        }
+
+
+class _Slots:
+    """Ограничитель параллельности, выдающий места по приоритету"""
+
+    def __init__(self, size: int):
+        self.free = size
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority: int, job: Optional[Job] = None):
+        if self.free > 0 and not self._waiters:
+            self.free -= 1
+            return
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if job:
+            job.waiter = fut
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def bump(self, job: Job, priority: int):
+        # Старая запись в куче пропустится в release(), так как future уже будет выполнен
+        if job.waiter and not job.waiter.done():
+            heapq.heappush(self._waiters, (priority, next(self._seq), job.waiter))
+
+    def release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.free += 1
+
+
+class JobQueue:
+    """Очередь тяжёлых задач с медиа.
+
+    Задачи выполняются не более чем по `workers` штук одновременно (сетевые
+    загрузки - в своих `io_workers` местах, чтобы не занимать перекодирование),
+    в порядке приоритета, дедуплицируются по ключу (обычно - ключу кеша) и переживают
+    перезапуск: незавершённые задачи сохраняются в `path` и запускаются
+    заново при старте.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        workers: int = 2,
+        io_workers: int = 4,
+        keep_finished: int = 256,
+    ):
+        self.path = path
+        self.slots = _Slots(workers)
+        self.io_slots = _Slots(io_workers)
+        self.io_kinds: Set[str] = set()
+        self.keep_finished = keep_finished
+        self.handlers: Dict[str, Callable[[Job], Awaitable[Any]]] = {}
+        self.jobs: Dict[str, Job] = {}
+        self.finished: "OrderedDict[str, Job]" = OrderedDict()
+        self._tasks: Set[asyncio.Future] = set()
+
+    def register(
+        self, kind: str, handler: Callable[[Job], Awaitable[Any]], io: bool = False
+    ):
+        self.handlers[kind] = handler
+        if io:
+            self.io_kinds.add(kind)
+
+    def _slots(self, job: Job) -> _Slots:
+        return self.io_slots if job.kind in self.io_kinds else self.slots
+
+    def get(self, key: str) -> Optional[Job]:
+        return self.jobs.get(key) or self.finished.get(key)
+
+    def submit(
+        self, kind: str, key: str, priority: int = Priority.INTERACTIVE, **args
+    ) -> Job:
+        """Ставит задачу в очередь или возвращает уже существующую с тем же ключом"""
+        if job := self.jobs.get(key):
+            if priority < job.priority:
+                job.priority = priority
+                self._slots(job).bump(job, priority)
+            return job
+        self.finished.pop(key, None)
+        job = self.jobs[key] = Job(kind, key, priority, args)
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._save()
+        return job
+
+    async def wait(self, job: Job, timeout: Optional[float] = None) -> Job:
+        """Ждёт задачу не дольше `timeout`, не отменяя её при отмене запроса"""
+        with contextlib.suppress(asyncio.TimeoutError, Exception):
+            await asyncio.wait_for(asyncio.shield(job.future), timeout)
+        return job
+
+    async def run(
+        self,
+        kind: str,
+        key: str,
+        priority: int = Priority.INTERACTIVE,
+        timeout: Optional[float] = None,
+        **args,
+    ) -> Job:
+        return await self.wait(self.submit(kind, key, priority, **args), timeout)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = Priority.INTERACTIVE):
+        """Место в очереди для работы, которую нельзя вынести в задачу (стриминг)"""
+        await self.slots.acquire(priority)
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+    async def _run(self, job: Job):
+        slots = self._slots(job)
+        await slots.acquire(job.priority, job)
+        try:
+            job.state, job.stage = "running", "Обработка"
+            job.result = await self.handlers[job.kind](job)
+            job.state, job.stage, job.progress = "done", "Готово", 1.0
+            job.future.set_result(job.result)
+        except asyncio.CancelledError:
+            # Остановка сервера: задача остаётся в файле и перезапустится при старте
+            slots.release()
+            raise
+        except Exception as ex:
+            print(traceback.format_exc())
+            job.state, job.stage = "error", "Ошибка"
+            job.error = "<br>".join(map(str, ex.args)) or type(ex).__name__
+            job.future.set_exception(ex)
+            job.future.exception()  # чтобы asyncio не ругался на непрочитанную ошибку
+        slots.release()
+        self.jobs.pop(job.key, None)
+        self.finished[job.key] = job
+        while len(self.finished) > self.keep_finished:
+            self.finished.popitem(last=False)
+        self._save()
+
+    def _save(self):
+        pending = [job.dump() for job in self.jobs.values()]
+        tmp = self.path.with_suffix(".tmp")
+        with contextlib.suppress(OSError):
+            tmp.write_text(json.dumps(pending))
+            os.replace(tmp, self.path)
+
+    def restore(self):
+        """Перезапускает задачи, не завершившиеся до остановки"""
+        try:
+            pending = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return
+        for job in sorted(pending, key=lambda j: j["priority"]):
+            if job["kind"] in self.handlers:
+                self.submit(job["kind"], job["key"], job["priority"], **job["args"])
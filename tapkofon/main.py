@@ -1,28 +1,47 @@
 # Copyright 2022 d4n13l3k00.
 # SPDX-License-Identifier: 	AGPL-3.0-or-later
 
+import asyncio
 import contextlib
+import datetime
 import hashlib
 import io
+import itertools
 import os
+import secrets
 import sys
 import time
 import traceback
 from pathlib import Path
 from typing import *
 
+import accounts
+import api
 import config
+import jobs
+import mediacache
+import metrics
 import models
-import speech_recognition as sr
+import rpc
+import store
+import timing
+import traffic
+import transcode
 import utils
 from fastapi import Cookie, FastAPI, File, Form, Request, UploadFile
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.templating import Jinja2Templates
-from PIL import Image
-from pydub import AudioSegment
-from telethon import TelegramClient, errors, functions, types
+from telethon import errors, events, types
+from telethon.utils import get_peer_id
 
-config = config.Config()
+config = config.load()
 config.access_cookie = (
     hashlib.sha256(os.urandom(32)).hexdigest()
     if not hasattr(config, "access_cookie")
@@ -34,31 +53,105 @@ if __name__ == "__main__":
     sys.exit(0)
 
 templates = Jinja2Templates(directory="templates")
+if config.minify_html:
+    templates.env.loader = traffic.MinifyingLoader("templates")
+
+sampler: Optional[timing.Sampler] = None
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    global sampler
+    if config.profile_enabled:
+        sampler = timing.Sampler(
+            Path.cwd().parent / "session" / "profiles",
+            interval=config.profile_interval_ms / 1000,
+        )
+        sampler.start()
+    tasks = [asyncio.ensure_future(metrics.watch_loop_lag())]
+    if config.account_idle_timeout:
+        tasks.append(
+            asyncio.ensure_future(accounts.watch_idle(config.account_idle_timeout))
+        )
+    queue.restore()
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-app = FastAPI(title="Tapkofon API", version="1.0")
+
+app = FastAPI(title="Tapkofon API", version="1.0", lifespan=lifespan)
+app.add_middleware(traffic.CompressionMiddleware, minimum_size=config.compress_min_size)
 if (path := (Path.cwd().parent / "session")) and not path.exists():
     path.mkdir(parents=True)
-user = TelegramClient("../session/session", config.api_id, config.api_hash)
-user.parse_mode = "html"
+accounts = accounts.Accounts(config, path)
+# внутри проверки доступа: к этому моменту аккаунт запроса уже выбран
+app.add_middleware(accounts.busy)
+# клиент, планировщик и кеш аккаунта текущего запроса
+user = accounts.proxy("client")
+scheduler = accounts.proxy("scheduler")
+media = accounts.proxy("media")
+
 
 ##### / Работа с подключением / #####
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
-    if request.url.path != "/pass":
-        if config.passwd:
-            if (
-                "access_token" not in request.cookies
-                or request.cookies["access_token"] != config.access_cookie
-            ):
-                return RedirectResponse("/pass")
-        else:
-            response = await call_next(request)
-            response.set_cookie("access_token", config.access_cookie)
-            return response
+    # кука доступа выбирает аккаунт; без неё - основной, если нет ни пароля,
+    # ни кодов аккаунтов
+    account = accounts.by_token(request.cookies.get("access_token"))
+    locked = bool(config.passwd or config.accounts)
+    if account is None and locked and request.url.path != "/pass":
+        return RedirectResponse("/pass")
+    accounts.activate(account or accounts.default)
     response = await call_next(request)
+    if account is None and not locked and request.url.path != "/pass":
+        response.set_cookie("access_token", accounts.default.token)
     return response
 
 
+@app.middleware("http")
+async def track_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.http_duration.observe(
+            request.method,
+            route.path if route else "unmatched",
+            status,
+            value=time.perf_counter() - start,
+        )
+
+
+@app.middleware("http")
+async def add_server_timing(request: Request, call_next):
+    timing.start()
+    start = time.perf_counter()
+    response = await call_next(request)
+    total = time.perf_counter() - start
+    if config.server_timing:
+        response.headers["Server-Timing"] = timing.header(total)
+    if sampler and total * 1000 >= config.profile_threshold_ms:
+        if path := await _in_thread(
+            sampler.dump, start, start + total, request.url.path
+        ):
+            print(f"Slow request {request.url.path} ({total:.2f}s), profile: {path}")
+    return response
+
+
+@app.get("/metrics", description="Метрики Prometheus")
+async def metrics_():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/logout", description="Деавторизоваться", response_class=HTMLResponse)
 async def logout():
     await user.log_out()
@@ -78,13 +171,15 @@ async def auth_old():
 async def passwd(
     password: Optional[str] = None, access_token: Optional[str] = Cookie(None)
 ):
-    if not config.passwd:
-        r = RedirectResponse("/")
-        r.set_cookie("access_token", config.access_cookie)
-        return r
-    if (password == config.passwd) or (access_token == config.access_cookie):
+    if password:
+        account = accounts.by_password(password)
+    else:
+        account = accounts.by_token(access_token)
+        if account is None and not config.passwd and not config.accounts:
+            account = accounts.default
+    if account:
         r = RedirectResponse("/")
-        r.set_cookie("access_token", config.access_cookie)
+        r.set_cookie("access_token", account.token)
         return r
     if not password:
         return templates.get_template("pass/pass.html").render()
@@ -156,91 +251,714 @@ async def auth(
         )
 
 
+##### / Условные запросы (ETag) / #####
+# меняется при перезапуске, чтобы новый код и шаблоны давали новые ETag
+BOOT_ID = os.urandom(4).hex()
+
+
+def _etag(*parts) -> str:
+    account = accounts.current().name
+    digest = hashlib.blake2b(repr((BOOT_ID, account, *parts)).encode(), digest_size=8)
+    return f'W/"{digest.hexdigest()}"'
+
+
+def _etag_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
+def _not_modified(request: Request, etag: str) -> Optional[Response]:
+    if tags := request.headers.get("if-none-match"):
+        if tags.strip() == "*" or etag in (t.strip() for t in tags.split(",")):
+            return Response(status_code=304, headers=_etag_headers(etag))
+    return None
+
+
+def _dialogs_changed():
+    accounts.current().dialogs_version += 1
+
+
+@accounts.on(events.MessageRead(inbox=True))
+@accounts.on(events.ChatAction())
+async def bump_dialogs_version(event):
+    _dialogs_changed()
+
+
 ##### / Список чатов / #####
 
 
+DIALOG_KINDS = ("users", "groups", "channels")
+
+
+def _dialog_kind(dialog) -> str:
+    if dialog.is_user:
+        return "users"
+    return "groups" if dialog.is_group else "channels"
+
+
+def _dialog_cursor(dialog) -> str:
+    top = dialog.message.id if dialog.message else 0
+    return f"{int(dialog.date.timestamp()) if dialog.date else 0}.{top}.{dialog.id}"
+
+
+def _dialog_offset(cursor: Optional[str]) -> Dict[str, Any]:
+    if not cursor:
+        return {}
+    date, top, peer = (int(p) for p in cursor.split("."))
+    return dict(
+        offset_date=datetime.datetime.fromtimestamp(date, datetime.timezone.utc),
+        offset_id=top,
+        offset_peer=peer,
+    )
+
+
+async def _dialogs_page(
+    cursor: Optional[str], unread: bool, archived: bool, kind: Optional[str]
+) -> Tuple[list, Optional[str]]:
+    """Одна страница диалогов и курсор следующей.
+
+    Telegram фильтрует на сервере только архив, остальные фильтры
+    применяются к пачкам GetDialogs, пока страница не заполнится или не
+    будет просмотрено dialogs_scan_limit диалогов.
+    """
+    limit = config.dialogs_page_size
+    batch = max(limit, 100) if unread or kind else limit
+    offset = _dialog_offset(cursor)
+    chats, scanned = [], 0
+    while True:
+        with timing.span("get_dialogs"):
+            dialogs = await scheduler.get_dialogs(
+                limit=batch, archived=archived, **offset
+            )
+        scanned += len(dialogs)
+        for dialog in dialogs:
+            # закреплённые уже показаны на первой странице
+            if cursor and dialog.pinned:
+                continue
+            if unread and not (dialog.unread_count or dialog.unread_mentions_count):
+                continue
+            if kind and _dialog_kind(dialog) != kind:
+                continue
+            chats.append(dialog)
+            if len(chats) == limit:
+                return chats, _dialog_cursor(dialog)
+        if len(dialogs) < batch:
+            return chats, None
+        last = _dialog_cursor(dialogs[-1])
+        if scanned >= config.dialogs_scan_limit:
+            return chats, last
+        offset = _dialog_offset(last)
+
+
+##### / Спрайт аватарок / #####
+# плитки: {кеш}/_avatars/{peer}/{photo_id}.fmt, спрайты: {кеш}/_avatars/_sprites/{key}.fmt
+SPRITES_REMEMBERED = 64
+# (аккаунт, ключ спрайта) -> (peer id, сущность) по порядку плиток
+_sprites: Dict[Tuple[str, str], List[Tuple[int, Any]]] = {}
+_sprite_builds: Dict[Tuple[str, str], asyncio.Future] = {}
+
+
+def _sprite_id(key: str) -> Tuple[str, str]:
+    return accounts.current().name, key
+
+
+def _photo_id(entity) -> Optional[int]:
+    return getattr(getattr(entity, "photo", None), "photo_id", None)
+
+
+def _sprite(members: List[Tuple[int, Any]]) -> Tuple[Optional[str], Dict[int, int]]:
+    """Ключ спрайта для страницы чатов и вертикальные смещения плиток по id чата.
+
+    Ключ зависит от photo_id участников, поэтому смена фото даёт новый
+    спрайт, а браузер может кешировать старый без ревалидации.
+    """
+    size = config.avatar_sprite_size
+    members = [(peer, entity) for peer, entity in members if _photo_id(entity)]
+    if not size or not members:
+        return None, {}
+    key = hashlib.blake2b(
+        repr(
+            (size, config.pic_format, [(p, _photo_id(e)) for p, e in members])
+        ).encode(),
+        digest_size=8,
+    ).hexdigest()
+    _sprites.pop(_sprite_id(key), None)
+    _sprites[_sprite_id(key)] = members
+    while len(_sprites) > SPRITES_REMEMBERED:
+        del _sprites[next(iter(_sprites))]
+    return key, {peer: i * size for i, (peer, _) in enumerate(members)}
+
+
+def _make_avatar_tile(data: bytes, file: str):
+    from PIL import Image, ImageOps
+
+    size = config.avatar_sprite_size
+    im = ImageOps.fit(Image.open(io.BytesIO(data)).convert("RGB"), (size, size))
+    im.save(file, config.pic_format, quality=config.pic_quality)
+
+
+def _make_sprite(tiles: List[Optional[str]], file: str):
+    from PIL import Image
+
+    size = config.avatar_sprite_size
+    sheet = Image.new("RGB", (size, size * len(tiles)), (255,) * 3)
+    for i, tile in enumerate(tiles):
+        if tile:
+            with Image.open(tile) as im:
+                sheet.paste(im, (0, i * size))
+    sheet.save(f"{file}.part", config.pic_format, quality=config.pic_quality)
+    os.replace(f"{file}.part", file)
+
+
+async def _avatar_tile(peer: int, entity) -> Optional[str]:
+    """Плитка аватарки из кеша, при смене photo_id качается заново.
+
+    None - фото недоступно насовсем. Временные ошибки (FloodWait, сеть)
+    пробрасываются: спрайт с пустой плиткой закешировался бы навсегда.
+    """
+    folder = f"{media.root}/_avatars/{peer}"
+    file = f"{folder}/{_photo_id(entity)}.{config.pic_format}"
+    if os.path.exists(file):
+        return file
+    data = await scheduler.download_profile_photo(entity, bytes)
+    if not data:
+        return None
+    os.makedirs(folder, exist_ok=True)
+    for old in os.listdir(folder):
+        os.unlink(f"{folder}/{old}")
+    media.forget("_avatars", str(peer))
+    await _in_thread(_make_avatar_tile, data, file)
+    media.touch(file)
+    return file
+
+
+async def _build_sprite(key: str) -> str:
+    folder = f"{media.root}/_avatars/_sprites"
+    file = f"{folder}/{key}.{config.pic_format}"
+    tiles = await asyncio.gather(*(_avatar_tile(*m) for m in _sprites[_sprite_id(key)]))
+    os.makedirs(folder, exist_ok=True)
+    await _in_thread(_make_sprite, tiles, file)
+    # спрайты страниц, которых уже нет в памяти, больше никто не запросит
+    for old in os.listdir(folder):
+        if _sprite_id(old.partition(".")[0]) not in _sprites:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(f"{folder}/{old}")
+    media.forget("_avatars", "_sprites")
+    media.touch(file)
+    return file
+
+
+@app.get("/avatars/{key}", description="Спрайт аватарок страницы чатов")
+async def avatar_sprite(key: str):
+    if not user.is_connected():
+        await user.connect()
+    if not await user.is_user_authorized():
+        return templates.get_template("auth/not_authorized.html").render()
+    file = f"{media.root}/_avatars/_sprites/{key}.{config.pic_format}"
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+    try:
+        if hot := media.hot.get(file):
+            return Response(hot.data, media_type=hot.media_type, headers=headers)
+        fresh = not os.path.exists(file)
+        if fresh:
+            sprite = _sprite_id(key)
+            if not key.isalnum() or sprite not in _sprites:
+                return Response(status_code=404)
+            # одна сборка на ключ, даже если картинку запросили несколько раз
+            if sprite not in _sprite_builds:
+                build = _sprite_builds[sprite] = asyncio.ensure_future(
+                    _build_sprite(key)
+                )
+                build.add_done_callback(lambda _: _sprite_builds.pop(sprite, None))
+            await asyncio.shield(_sprite_builds[sprite])
+        media.touch(file)
+        media_type = f"image/{config.pic_format}"
+        if (data := await _hot_load(file, file, media_type, fresh)) is not None:
+            return Response(data, media_type=media_type, headers=headers)
+        return StreamingResponse(
+            open(file, mode="rb"), media_type=media_type, headers=headers
+        )
+    except (errors.RPCError, rpc.Paused, OSError) as ex:
+        # не все плитки скачались - спрайт не собран, браузер спросит снова
+        return Response(
+            status_code=503,
+            headers={
+                "Retry-After": str(int(getattr(ex, "seconds", 0)) or 5),
+                "Cache-Control": "no-store",
+            },
+        )
+    except Exception as ex:
+        return HTMLResponse(
+            templates.get_template("error.html").render(
+                error="<br>".join(map(str, ex.args))
+            )
+        )
+
+
 @app.get("/", description="Список чатов", response_class=HTMLResponse)
-async def get_dialogs():
+async def get_dialogs(
+    request: Request,
+    cursor: Optional[str] = None,
+    unread: bool = False,
+    archived: bool = False,
+    kind: Optional[str] = None,
+):
     if not user.is_connected():
         await user.connect()
     if not await user.is_user_authorized():
         return templates.get_template("auth/not_authorized.html").render()
-    dialogs = await user.get_dialogs()
+    # закреп и архив событий не дают, поэтому ETag живёт не дольше etag_max_age
+    etag = _etag(
+        "dialogs",
+        accounts.current().dialogs_version,
+        config.etag_max_age and int(time.time() // config.etag_max_age),
+        bool(config.passwd or config.accounts),
+        str(request.query_params),
+    )
+    if response := _not_modified(request, etag):
+        return response
+    if kind not in DIALOG_KINDS:
+        kind = None
+    try:
+        dialogs, next_cursor = await _dialogs_page(cursor, unread, archived, kind)
+    except Exception as ex:
+        return templates.get_template("error.html").render(
+            error="<br>".join(map(str, ex.args))
+        )
     chats = [
         models.Chat(id=chat.id, title=chat.title, unread=chat.unread_count)
         for chat in dialogs
     ]
-    return templates.get_template("chats.html").render(
-        chats=chats, is_passwd=bool(config.passwd)
+    sprite, avatars = _sprite([(chat.id, chat.entity) for chat in dialogs])
+    filters = {
+        k: v
+        for k, v in (("unread", unread), ("archived", archived), ("kind", kind))
+        if v
+    }
+    with timing.span("render"):
+        return HTMLResponse(
+            templates.get_template("chats.html").render(
+                chats=chats,
+                is_passwd=bool(config.passwd or config.accounts),
+                account=accounts.current().name if config.accounts else None,
+                filters=filters,
+                next_cursor=next_cursor,
+                first_page=not cursor,
+                sprite=sprite,
+                avatars=avatars,
+                avatar_size=config.avatar_sprite_size,
+            ),
+            headers=_etag_headers(etag),
+        )
+
+
+##### / Локальная копия сообщений / #####
+CHAT_PAGE = 10
+
+# база и шина событий аккаунта текущего запроса
+history = accounts.proxy("history")
+updates = accounts.proxy("updates")
+_background: Set[asyncio.Future] = set()
+
+
+def _in_background(coro):
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def _store_live(m: types.Message):
+    message = store.StoredMessage.from_telethon(m)
+    await history.live_message(message)
+    updates.publish(message.chat, message.id)
+    _dialogs_changed()
+
+
+@accounts.on(events.NewMessage())
+async def store_new_message(event: events.NewMessage.Event):
+    m = event.message
+    if m.sender is None and m.sender_id:
+        with contextlib.suppress(Exception):
+            await m.get_sender()
+    await _store_live(m)
+
+
+@accounts.on(events.MessageEdited())
+async def store_edited_message(event: events.MessageEdited.Event):
+    await history.put([store.StoredMessage.from_telethon(event.message)])
+
+
+@accounts.on(events.MessageDeleted())
+async def store_deleted_messages(event: events.MessageDeleted.Event):
+    await history.delete(event.chat_id, event.deleted_ids)
+    _dialogs_changed()
+
+
+async def _open_chat(id: Union[int, str]) -> store.StoredChat:
+    if isinstance(id, int) and (chat := await history.chat(id)):
+        return chat
+    with timing.span("get_entity"):
+        entity = await scheduler.get_entity(id)
+    key = id if isinstance(id, int) else get_peer_id(entity)
+    chat = await history.chat(key) or store.StoredChat(id=key)
+    chat.title = getattr(entity, "title", None)
+    chat.first_name = getattr(entity, "first_name", None)
+    return chat
+
+
+async def _sync_head(chat: store.StoredChat):
+    """Сверяет начало чата с Telegram после перерыва в событиях"""
+    with timing.span("get_messages"):
+        fetched = await scheduler.get_messages(chat.id, limit=config.store_backfill)
+    rows = [store.StoredMessage.from_telethon(m, chat.id) for m in fetched]
+    complete = len(rows) < config.store_backfill
+    low = 0 if complete else min(m.id for m in rows)
+    high = max((m.id for m in rows), default=0)
+    if chat.covered and low <= chat.high:
+        # свежая страница перекрывает покрытие - пропуска нет
+        chat.low = min(chat.low, low)
+        chat.high = max(chat.high, high)
+    else:
+        chat.low, chat.high = low, high
+    chat.complete = chat.complete or complete
+    await history.sync(chat.id, low, sys.maxsize, rows)
+    chat.live = True
+
+
+async def _backfill(chat: store.StoredChat):
+    """Догружает историю старше покрытого диапазона"""
+    with timing.span("get_messages"):
+        fetched = await scheduler.get_messages(
+            chat.id, limit=config.store_backfill, offset_id=chat.low
+        )
+    rows = [store.StoredMessage.from_telethon(m, chat.id) for m in fetched]
+    chat.complete = len(rows) < config.store_backfill
+    low = 0 if chat.complete else min(m.id for m in rows)
+    await history.sync(chat.id, low, chat.low - 1, rows)
+    chat.low = low
+
+
+async def _refresh(
+    chat: store.StoredChat, enough: Callable[[], Awaitable[bool]]
+) -> store.StoredChat:
+    """Сверяет чат и догружает историю, пока `enough()` не скажет хватит"""
+    try:
+        if not chat.live:
+            await _sync_head(chat)
+        while not chat.complete and not await enough():
+            await _backfill(chat)
+    except (OSError, asyncio.TimeoutError):
+        # нет связи: показываем то, что уже скопировано, а после
+        # переподключения чаты сверятся заново
+        await history.stale()
+        chat.live = False
+        if not chat.covered:
+            raise
+    except rpc.Paused:
+        if not chat.covered:
+            raise
+    await history.save_chat(chat)
+    # версию ведёт база, поэтому перечитываем чат после сверки
+    return await history.chat(chat.id) or chat
+
+
+async def _replies(
+    chat: store.StoredChat, messages: List[store.StoredMessage]
+) -> Dict[int, store.StoredMessage]:
+    ids = sorted({m.reply_to for m in messages if m.reply_to})
+    if not ids:
+        return {}
+    replies = await history.get(chat.id, ids)
+    if missing := [i for i in ids if i not in replies]:
+        # ответы одним запросом на страницу вместо запроса на каждое сообщение
+        with contextlib.suppress(OSError, asyncio.TimeoutError, rpc.Paused):
+            with timing.span("reply"):
+                fetched = await scheduler.get_messages(chat.id, ids=missing)
+            rows = [store.StoredMessage.from_telethon(r, chat.id) for r in fetched if r]
+            await history.put(rows)
+            replies.update((r.id, r) for r in rows)
+    return replies
+
+
+# имена файлов, которые Telegram даёт стикерам
+STICKER_FILES = ("sticker.webp", "sticker.webm", "AnimatedSticker.tgs")
+
+
+def _media(m: store.StoredMessage) -> Optional[models.MessageMedia]:
+    if m.size is None:
+        return None
+    typ = m.mime.split("/")[0] if m.mime else None
+    if m.filename in STICKER_FILES or m.mime == "application/x-tgsticker":
+        # стикеры отдаются отрисованной картинкой
+        typ = "image"
+    return models.MessageMedia(
+        type=m.mime,
+        typ=typ,
+        size=utils.humanize(m.size),
+        filename=m.filename,
     )
 
 
+def _text(m: store.StoredMessage) -> Optional[str]:
+    return utils.replacing_text(m.text) if m.text else None
+
+
+def _message(
+    m: store.StoredMessage, r: Optional[store.StoredMessage] = None
+) -> models.Message:
+    reply = None
+    if r:
+        reply = models.ReplyMessage(
+            name=r.sender_title or r.sender_first_name or "",
+            id=r.id,
+            file=_media(r),
+            text=_text(r),
+        )
+    return models.Message(
+        id=m.id,
+        sender=models.Peer(
+            id=m.sender_id or m.chat,
+            title=m.sender_title,
+            first_name=m.sender_first_name,
+        ),
+        text=_text(m),
+        file=_media(m),
+        reply=reply,
+        mentioned=m.mentioned,
+        date=datetime.datetime.fromtimestamp(m.date, datetime.timezone.utc).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        ),
+        out=m.out,
+    )
+
+
+async def _mark_read(chat: store.StoredChat):
+    with contextlib.suppress(Exception):
+        await user.send_read_acknowledge(chat.id)
+        _dialogs_changed()
+
+
 ##### / Чат / #####
 @app.get("/chat/{id}", description="Чат", response_class=HTMLResponse)
-async def chat(id: str, page: Optional[int] = 0):
+async def chat(request: Request, id: str, page: Optional[int] = 0):
     # sourcery skip: avoid-builtin-shadow
-    if not user.is_connected():
-        await user.connect()
+    with contextlib.suppress(OSError):
+        if not user.is_connected():
+            await user.connect()
     if not await user.is_user_authorized():
         return templates.get_template("auth/not_authorized.html").render()
     try:
         with contextlib.suppress(Exception):
             id = int(id)
-        chat = await user.get_entity(id)
-        await user.conversation(chat).mark_read()
-        messages = await user.get_messages(id, limit=10, add_offset=10 * page)
-        msgs = []
-        for m in messages:
-            m: types.Message
-            r = await m.get_reply_message()
-            reply = None
-            if r:
-                name = (
-                    r.sender.title
-                    if hasattr(r.sender, "title")
-                    else r.sender.first_name
-                )
-                if r.file:
-                    rfile = models.MessageMedia(
-                        type=r.file.mime_type,
-                        typ=r.file.mime_type.split("/")[0],
-                        size=utils.humanize(r.file.size),
-                        filename=r.file.name,
-                    )
-                else:
-                    rfile = None
-                reply = models.ReplyMessage(
-                    name=name,
-                    id=r.id,
-                    file=rfile,
-                    text=utils.replacing_text(r.text) if r.text else None,
-                )
-            if m.file:
-                file = models.MessageMedia(
-                    type=m.file.mime_type,
-                    typ=m.file.mime_type.split("/")[0],
-                    size=utils.humanize(m.file.size),
-                    filename=m.file.name,
-                )
-            else:
-                file = None
-            msgs.append(
-                models.Message(
-                    id=m.id,
-                    sender=m.sender,
-                    text=utils.replacing_text(m.text) if m.text else None,
-                    file=file,
-                    reply=reply,
-                    mentioned=m.mentioned,
-                    date=m.date.strftime("%Y-%m-%d %H:%M:%S"),
-                    out=m.out,
+        chat = await _open_chat(id)
+
+        async def enough() -> bool:
+            return await history.count(chat) >= CHAT_PAGE * (page + 1)
+
+        chat = await _refresh(chat, enough)
+        # до проверки ETag: чат отмечается прочитанным и при ответе 304
+        if chat.live:
+            _in_background(_mark_read(chat))
+        etag = _etag(
+            "chat", chat.id, page, chat.version, chat.low, chat.high, chat.title
+        )
+        if response := _not_modified(request, etag):
+            return response
+        with timing.span("store"):
+            messages = await history.page(chat, CHAT_PAGE, CHAT_PAGE * page)
+        replies = await _replies(chat, messages)
+        msgs = [_message(m, replies.get(m.reply_to)) for m in messages]
+        with timing.span("render"):
+            return HTMLResponse(
+                templates.get_template("chat.html").render(
+                    messages=msgs, chat=chat, page=page
+                ),
+                headers=_etag_headers(etag),
+            )
+    except Exception as ex:
+        return templates.get_template("error.html").render(
+            error="<br>".join(map(str, ex.args))
+        )
+
+
+##### / Новые сообщения (long-poll) / #####
+@app.get(
+    "/chat/{id}/new",
+    description="Сообщения новее after, ждёт их до poll_timeout секунд",
+    response_class=HTMLResponse,
+)
+async def chat_new(id: str, after: int = 0):
+    # sourcery skip: avoid-builtin-shadow
+    with contextlib.suppress(OSError):
+        if not user.is_connected():
+            await user.connect()
+    if not await user.is_user_authorized():
+        return templates.get_template("auth/not_authorized.html").render()
+    try:
+        with contextlib.suppress(Exception):
+            id = int(id)
+        chat = await _open_chat(id)
+        # подписка до проверки, чтобы не пропустить сообщение между ними
+        with updates.subscribe(chat.id) as fresh:
+            messages = await history.newer(chat, after, CHAT_PAGE)
+            if not messages and await updates.wait(fresh, config.poll_timeout):
+                chat = await history.chat(chat.id) or chat
+                messages = await history.newer(chat, after, CHAT_PAGE)
+        replies = await _replies(chat, messages)
+        response = HTMLResponse(
+            templates.get_template("chat_new.html").render(
+                messages=[_message(m, replies.get(m.reply_to)) for m in messages],
+                chat=chat,
+            )
+        )
+        response.headers["X-Last-Id"] = str(messages[0].id if messages else after)
+        return response
+    except Exception as ex:
+        return HTMLResponse(
+            templates.get_template("error.html").render(
+                error="<br>".join(map(str, ex.args))
+            ),
+            status_code=500,
+        )
+
+
+##### / Поиск / #####
+def _search_cursor(phase: str, m) -> str:
+    date = m.date if isinstance(m.date, int) else int(m.date.timestamp())
+    if phase == "l":
+        return f"l.{date}.{m.chat}.{m.id}"
+    return f"r.{date}.{m.id}"
+
+
+async def _search_remote(
+    q: str, chat: Optional[store.StoredChat], pos: List[int], limit: int
+) -> Tuple[List[store.StoredMessage], Optional[str]]:
+    """messages.Search (или SearchGlobal) по истории вне локального покрытия"""
+    if chat is not None:
+        offset_id = pos[1] if pos else chat.low or 0
+        with timing.span("search"):
+            fetched = await scheduler.get_messages(
+                chat.id, search=q, limit=limit, offset_id=offset_id
+            )
+    else:
+        with timing.span("search"):
+            fetched = await scheduler.get_messages(
+                None,
+                search=q,
+                limit=limit,
+                offset_id=pos[1] if pos else 0,
+                offset_date=(
+                    datetime.datetime.fromtimestamp(pos[0], datetime.timezone.utc)
+                    if pos
+                    else None
+                ),
+            )
+    fetched = [m for m in fetched if m]
+    rows = [store.StoredMessage.from_telethon(m) for m in fetched]
+    for m in fetched:
+        if entity := getattr(m, "chat", None):
+            await history.name_chat(
+                store.StoredChat(
+                    id=m.chat_id,
+                    title=getattr(entity, "title", None),
+                    first_name=getattr(entity, "first_name", None),
                 )
             )
-        return templates.get_template("chat.html").render(
-            messages=msgs, chat=chat, page=page
+    # найденное попадает в индекс, а уже показанное из покрытия - отбрасываем
+    await history.put(rows)
+    chats = await history.chats(list({m.chat for m in rows}))
+    rows = [
+        m
+        for m in rows
+        if not ((c := chats.get(m.chat)) and c.covered and c.low <= m.id <= c.high)
+    ]
+    cursor = _search_cursor("r", fetched[-1]) if len(fetched) == limit else None
+    return rows, cursor
+
+
+async def _search(
+    q: str, chat: Optional[store.StoredChat], cursor: Optional[str]
+) -> Tuple[List[store.StoredMessage], Optional[str], bool]:
+    """Сначала локальный индекс, затем Telegram для непокрытой истории.
+
+    Курсор: `l.{date}.{chat}.{id}` - позиция в локальном индексе,
+    `r.{date}.{id}` - позиция в выдаче Telegram.
+    Возвращает результаты, курсор следующей страницы и доступность Telegram.
+    """
+    limit = config.search_page_size
+    phase, *pos = (cursor or "l").split(".")
+    pos = [int(p) for p in pos]
+    results = []
+    if phase == "l":
+        with timing.span("fts"):
+            rows = await history.search(
+                q, chat.id if chat else None, tuple(pos) or None, limit + 1
+            )
+        results = rows[:limit]
+        if len(rows) > limit:
+            return results, _search_cursor("l", results[-1]), True
+        pos = []
+    if chat is not None and chat.complete:
+        return results, None, True
+    if len(results) == limit:
+        return results, "r", True
+    try:
+        rows, cursor = await _search_remote(q, chat, pos, limit - len(results))
+    except (OSError, asyncio.TimeoutError, rpc.Paused):
+        return results, None, False
+    return results + rows, cursor, True
+
+
+async def _search_page(
+    url: str, q: Optional[str], chat: Optional[store.StoredChat], cursor: Optional[str]
+):
+    results, next_cursor, online = [], None, True
+    if q and q.strip():
+        found, next_cursor, online = await _search(q.strip(), chat, cursor)
+        chats = await history.chats(list({m.chat for m in found}))
+        results = [
+            models.SearchResult(
+                chat=m.chat,
+                chat_title=(c := chats.get(m.chat)) and (c.title or c.first_name),
+                message=_message(m),
+            )
+            for m in found
+        ]
+    with timing.span("render"):
+        return templates.get_template("search.html").render(
+            url=url, q=q, chat=chat, results=results, cursor=next_cursor, online=online
         )
+
+
+@app.get("/search", description="Поиск по всем чатам", response_class=HTMLResponse)
+async def search(q: Optional[str] = None, cursor: Optional[str] = None):
+    if not user.is_connected():
+        await user.connect()
+    if not await user.is_user_authorized():
+        return templates.get_template("auth/not_authorized.html").render()
+    try:
+        return await _search_page("/search", q, None, cursor)
     except Exception as ex:
-        return templates.get_template("error.html").render(error="<br>".join(ex.args))
+        return templates.get_template("error.html").render(
+            error="<br>".join(map(str, ex.args))
+        )
+
+
+@app.get("/chat/{id}/search", description="Поиск по чату", response_class=HTMLResponse)
+async def chat_search(id: str, q: Optional[str] = None, cursor: Optional[str] = None):
+    # sourcery skip: avoid-builtin-shadow
+    if not user.is_connected():
+        await user.connect()
+    if not await user.is_user_authorized():
+        return templates.get_template("auth/not_authorized.html").render()
+    try:
+        with contextlib.suppress(Exception):
+            id = int(id)
+        chat = await _open_chat(id)
+        return await _search_page(f"/chat/{id}/search", q, chat, cursor)
+    except Exception as ex:
+        return templates.get_template("error.html").render(
+            error="<br>".join(map(str, ex.args))
+        )
 
 
 ##### / Реплай / #####
@@ -281,14 +999,16 @@ async def send_message(
     try:
         with contextlib.suppress(Exception):
             id = int(id)
-        chat = await user.get_entity(id)
+        chat = await scheduler.get_entity(id)
         if file and file.file.read():
             file.file.seek(0)
             f = io.BytesIO(file.file.read())
             f.name = file.filename
-            await user.send_file(chat, f, caption=text, reply_to=reply_to)
+            sent = await user.send_file(chat, f, caption=text, reply_to=reply_to)
         else:
-            await user.send_message(chat, text, reply_to=reply_to)
+            sent = await user.send_message(chat, text, reply_to=reply_to)
+        if sent:
+            await _store_live(sent)
         return templates.get_template("success.html").render(
             id=id, text="Сообщение отправлено"
         )
@@ -297,6 +1017,10 @@ async def send_message(
 
 
 ##### / Работа с сообщениями / #####
+# Действия идут сразу по id сообщения, без предварительного get_messages
+BULK_ACTIONS = ("read", "delete", "forward")
+
+
 @app.get(
     "/chat/{id}/edit/{msg_id}",
     description="Изменить сообщение",
@@ -310,9 +1034,11 @@ async def edit(id: str, msg_id: int):  # sourcery skip: avoid-builtin-shadow
     try:
         with contextlib.suppress(Exception):
             id = int(id)
-        msg = await user.get_messages(id, ids=msg_id)
+        chat = await _open_chat(id)
+        msg = (await history.get(chat.id, [msg_id])).get(msg_id)
+        if msg is None:
+            msg = await scheduler.get_messages(id, ids=msg_id)
         if msg:
-            msg: types.Message
             return templates.get_template("edit.html").render(
                 chat=id, id=msg.id, text=msg.text
             )
@@ -341,22 +1067,22 @@ async def edit_message(id: str, msg_id: int = Form(...), text: str = Form(...)):
     try:
         with contextlib.suppress(Exception):
             id = int(id)
-        msg = await user.get_messages(id, ids=msg_id)
-        if msg:
-            msg: types.Message
-            await msg.edit(text)
-            return templates.get_template("success.html").render(
-                id=id, text="Сообщение изменено"
-            )
-        return HTMLResponse(
-            templates.get_template("error.html").render(
-                error="Такого сообщения не существует"
-            )
+        chat = await _open_chat(id)
+        if edited := await user.edit_message(chat.id, msg_id, text):
+            await history.put([store.StoredMessage.from_telethon(edited, chat.id)])
+        return templates.get_template("success.html").render(
+            id=id, text="Сообщение изменено"
         )
     except Exception as ex:
         return templates.get_template("error.html").render(error="<br>".join(ex.args))
 
 
+async def _delete_messages(chat: store.StoredChat, ids: List[int]):
+    await user.delete_messages(chat.id, ids)
+    await history.delete(chat.id, ids)
+    _dialogs_changed()
+
+
 @app.get(
     "/chat/{id}/delete/{msg_id}",
     description="Удаление сообщения",
@@ -370,17 +1096,9 @@ async def delete_message(id: str, msg_id: int):
     try:
         with contextlib.suppress(Exception):
             id = int(id)
-        msg = await user.get_messages(id, ids=msg_id)
-        if msg:
-            msg: types.Message
-            await msg.delete()
-            return templates.get_template("success.html").render(
-                id=id, text="Сообщение удалено"
-            )
-        return HTMLResponse(
-            templates.get_template("error.html").render(
-                error="Такого сообщения не существует"
-            )
+        await _delete_messages(await _open_chat(id), [msg_id])
+        return templates.get_template("success.html").render(
+            id=id, text="Сообщение удалено"
         )
     except Exception as ex:
         return HTMLResponse(
@@ -388,9 +1106,516 @@ async def delete_message(id: str, msg_id: int):
         )
 
 
+@app.post(
+    "/chat/{id}/bulk",
+    description="API Действие над выбранными сообщениями",
+    response_class=HTMLResponse,
+)
+async def bulk_messages(
+    id: str,
+    action: str = Form(...),
+    ids: List[int] = Form([]),
+    to: Optional[str] = Form(None),
+):  # sourcery skip: avoid-builtin-shadow
+    """Прочитать, удалить или переслать выбранные сообщения одним запросом.
+
+    Telethon сам режет списки больше 100 id на пачки.
+    """
+    if not user.is_connected():
+        await user.connect()
+    if not await user.is_user_authorized():
+        return templates.get_template("auth/not_authorized.html").render()
+    try:
+        with contextlib.suppress(Exception):
+            id = int(id)
+        if action not in BULK_ACTIONS:
+            raise ValueError(f"Неизвестное действие: {action}")
+        if not ids:
+            raise ValueError("Не выбрано ни одного сообщения")
+        ids = sorted(set(ids))
+        chat = await _open_chat(id)
+        if action == "read":
+            await user.send_read_acknowledge(chat.id, max_id=ids[-1])
+            _dialogs_changed()
+            text = "Прочитано"
+        elif action == "delete":
+            await _delete_messages(chat, ids)
+            text = f"Удалено сообщений: {len(ids)}"
+        else:
+            if not to:
+                raise ValueError("Не указано, куда переслать")
+            with contextlib.suppress(Exception):
+                to = int(to)
+            target = await scheduler.get_entity(to)
+            for sent in await user.forward_messages(target, ids, chat.id) or []:
+                await _store_live(sent)
+            text = f"Переслано сообщений: {len(ids)}"
+        return templates.get_template("success.html").render(id=id, text=text)
+    except Exception as ex:
+        return templates.get_template("error.html").render(
+            error="<br>".join(map(str, ex.args))
+        )
+
+
+##### / Очередь обработки медиа / #####
+queue = jobs.JobQueue(
+    Path.cwd().parent / "session" / "jobs.json",
+    workers=config.jobs_workers,
+    io_workers=config.jobs_io_workers,
+)
+
+
+def _in_thread(func, *args):
+    return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def _job_message(job: jobs.Job) -> types.Message:
+    if not user.is_connected():
+        await user.connect()
+    # задачи фоновых приоритетов не отнимают лимиты у страниц
+    with contextlib.ExitStack() as stack:
+        if job.priority != jobs.Priority.INTERACTIVE:
+            stack.enter_context(rpc.background())
+        msg = await scheduler.get_messages(job.args["chat"], ids=job.args["msg_id"])
+    if not msg or not msg.file:
+        raise ValueError("Такого сообщения не существует")
+    return msg
+
+
+def _progress(job: jobs.Job) -> Callable[[int, int], None]:
+    def on_progress(current, total=1):
+        job.progress = current / total if total else 0.0
+
+    return on_progress
+
+
+async def _download(
+    msg: types.Message,
+    file: str,
+    progress_callback: Optional[Callable[[int, int], Any]] = None,
+) -> str:
+    # большие документы качаем в несколько соединений, остальное - как обычно
+    doc = msg.document
+    if (
+        config.download_connections > 1
+        and doc is not None
+        and doc.size >= config.download_parallel_mb * 1024 * 1024
+    ):
+        try:
+            return await accounts.current().downloader.download(
+                doc, file, progress_callback
+            )
+        except Exception as e:
+            # например, другой DC не принял авторизацию - не теряем загрузку
+            print(f"Parallel download of {file} failed, falling back: {e!r}")
+    return await msg.download_media(file, progress_callback=progress_callback)
+
+
+async def _audio_source(msg: types.Message, folder: str):
+    # ogg/opus и подобные ffmpeg читает прямо из потока загрузки,
+    # остальные (m4a и т.п.) требуют перемотки, поэтому сначала качаем файл
+    if msg.file.mime_type in transcode.PIPE_FRIENDLY:
+        return user.iter_download(msg.media)
+    # у каждого запроса свой файл: одновременные загрузки не мешают друг другу
+    return await _download(msg, f"{folder}/source.{secrets.token_hex(4)}.part")
+
+
+def _is_transcoded_audio(msg: types.Message) -> bool:
+    return msg.file.mime_type.split("/")[0] == "audio" and msg.file.ext != ".mp3"
+
+
+async def _audio_job(job: jobs.Job) -> str:
+    msg = await _job_message(job)
+    source = await _audio_source(msg, os.path.dirname(job.args["file"]))
+    return await transcode.transcode_audio(
+        source, job.args["file"], config.audio_format, config.audio_bitrate
+    )
+
+
+def _make_picture(data: bytes, file: str, size: Optional[int] = None):
+    from PIL import Image
+
+    m_ = io.BytesIO(data)
+    m_.name = "pic.png"
+    im = Image.open(m_)
+    # уменьшаем до перевода в RGBA, чтобы не гонять полноразмерную копию
+    im.thumbnail((size or config.pic_max_size,) * 2, 1)
+    im = im.convert("RGBA")
+    bg = Image.new("RGB", im.size, (255,) * 3)
+    bg.paste(im, mask=im.split()[3])
+    bg.save(file, config.pic_format, quality=config.pic_quality)
+
+
+async def _image_job(job: jobs.Job) -> str:
+    msg = await _job_message(job)
+    job.stage = "Загрузка"
+    data = await msg.download_media(bytes)
+    job.stage = "Сжатие"
+    with metrics.transcode_duration.time("image"):
+        await _in_thread(_make_picture, data, job.args["file"])
+    return job.args["file"]
+
+
+async def _file_job(job: jobs.Job) -> str:
+    msg = await _job_message(job)
+    job.stage = "Загрузка"
+    return await _download(msg, job.args["file"], _progress(job))
+
+
+async def _video_job(job: jobs.Job) -> str:
+    msg = await _job_message(job)
+    on_progress = _progress(job)
+    job.stage = "Загрузка"
+    source = await _download(msg, f"{job.args['file']}.src.part", on_progress)
+    job.stage, job.progress = "Сжатие", 0.0
+    with metrics.transcode_duration.time("video"):
+        return await transcode.transcode_video(
+            source,
+            job.args["file"],
+            fmt=config.video_format,
+            max_size=config.video_max_size,
+            bitrate=config.video_bitrate,
+            fps=config.video_fps,
+            duration=msg.file.duration,
+            on_progress=on_progress,
+        )
+
+
+def _sticker_thumb(msg: types.Message):
+    # PhotoPathSize - векторный контур, VideoSize - видео, они не подходят
+    thumbs = [
+        t
+        for t in getattr(msg.document, "thumbs", None) or []
+        if isinstance(t, (types.PhotoSize, types.PhotoCachedSize))
+    ]
+    return max(
+        thumbs,
+        key=lambda t: getattr(t, "size", None) or len(getattr(t, "bytes", b"")),
+        default=None,
+    )
+
+
+async def _sticker_job(job: jobs.Job) -> str:
+    msg = await _job_message(job)
+    mime = msg.file.mime_type
+    job.stage = "Загрузка"
+    data = None
+    if mime != "image/webp" and (thumb := _sticker_thumb(msg)):
+        # у анимированных стикеров есть готовое растровое превью
+        data = await msg.download_media(bytes, thumb=thumb)
+    if not data and mime == "video/webm":
+        source = await msg.download_media(f"{job.args['file']}.src.part")
+        job.stage = "Отрисовка"
+        data = await transcode.first_frame(source)
+    if not data and mime == "application/x-tgsticker":
+        raise ValueError("У анимированного стикера нет растрового превью")
+    if not data:
+        data = await msg.download_media(bytes)
+    job.stage = "Отрисовка"
+    with metrics.transcode_duration.time("sticker"):
+        await _in_thread(_make_picture, data, job.args["file"], config.sticker_size)
+    return job.args["file"]
+
+
+def _recognize_chunks(file: str) -> list:
+    """Режет запись по паузам на куски не длиннее `recognize_chunk_s`"""
+    # тяжёлые модули грузятся при первом распознавании, а не при старте
+    import speech_recognition as sr
+    from pydub import AudioSegment, silence
+
+    # распознаванию хватает 16 кГц моно, а в памяти это в разы меньше
+    song = AudioSegment.from_file(file).set_channels(1).set_frame_rate(16000)
+    limit = config.recognize_chunk_s * 1000
+    spans = silence.detect_nonsilent(
+        song, min_silence_len=500, silence_thresh=song.dBFS - 16, seek_step=10
+    ) or [[0, len(song)]]
+    chunks: List[List[int]] = []
+    for start, end in spans:
+        # речь без пауз длиннее лимита режем как есть
+        for cut in range(start, end, limit):
+            piece = [cut, min(cut + limit, end)]
+            if chunks and piece[1] - chunks[-1][0] <= limit:
+                chunks[-1][1] = piece[1]
+            else:
+                chunks.append(piece)
+    return [
+        sr.AudioData(seg.raw_data, seg.frame_rate, seg.sample_width)
+        for seg in (song[max(start - 200, 0) : end + 200] for start, end in chunks)
+    ]
+
+
+def _recognize_chunk(audio) -> str:
+    import speech_recognition as sr
+
+    try:
+        return sr.Recognizer().recognize_google(audio, language=config.recognize_lang)
+    except sr.UnknownValueError:
+        # тишина или неразборчивый кусок не должны ронять всё распознавание
+        return ""
+
+
+async def _recognize_file(job: jobs.Job, file: str) -> str:
+    chunks = await _in_thread(_recognize_chunks, file)
+    texts: List[Optional[str]] = [None] * len(chunks)
+    failed: List[Exception] = []
+    slots = asyncio.Semaphore(config.recognize_workers)
+
+    async def run(i: int, chunk):
+        async with slots:
+            try:
+                texts[i] = await _in_thread(_recognize_chunk, chunk)
+            except Exception as e:
+                failed.append(e)
+                texts[i] = "[…]"
+        job.progress = sum(t is not None for t in texts) / len(texts)
+        # промежуточный текст - готовые подряд с начала куски
+        job.partial = " ".join(
+            filter(None, itertools.takewhile(lambda t: t is not None, texts))
+        )
+
+    await asyncio.gather(*(run(i, c) for i, c in enumerate(chunks)))
+    if failed and len(failed) == len(chunks):
+        raise failed[0]
+    return " ".join(filter(None, texts))
+
+
+async def _recognize_job(job: jobs.Job) -> str:
+    folder = f"{media.root}/{job.args['chat']}/{job.args['msg_id']}"
+    msg = await _job_message(job)
+    os.makedirs(folder, exist_ok=True)
+    job.stage = "Загрузка"
+    if not _is_transcoded_audio(msg):
+        # в кеше лежит оригинал - из него и распознаём
+        if not (file := utils.cached_file(folder)):
+            file = await _download(msg, f"{folder}/{msg.file.name}", _progress(job))
+        temporary = False
+    else:
+        # mp3/amr для телефона ужат слишком сильно для распознавания и поиска
+        # пауз, поэтому берём оригинал и после распознавания удаляем
+        file = await _download(
+            msg, f"{folder}/recognize.{secrets.token_hex(4)}.part", _progress(job)
+        )
+        temporary = True
+    try:
+        job.stage, job.progress = "Распознавание", 0.0
+        with metrics.recognize_duration.time():
+            return await _recognize_file(job, file)
+    finally:
+        if temporary:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(file)
+
+
+def _job_key(kind: str, chat: Union[int, str], msg_id: int) -> str:
+    # у каждого аккаунта свой кеш, поэтому и задачи у них свои
+    return f"{kind}:{accounts.current().name}:{chat}:{msg_id}"
+
+
+def _own_job(job: jobs.Job) -> bool:
+    return job.args.get("account", accounts.default.name) == accounts.current().name
+
+
+def _account_job(handler: Callable[[jobs.Job], Awaitable[Any]]):
+    # восстановленные после перезапуска задачи не знают аккаунт запроса
+    async def run(job: jobs.Job):
+        with accounts.use(job.args.get("account")) as account, account.lease():
+            return await handler(job)
+
+    return run
+
+
+queue.register("audio", _account_job(_audio_job))
+queue.register("image", _account_job(_image_job))
+queue.register("file", _account_job(_file_job), io=True)
+queue.register("video", _account_job(_video_job))
+queue.register("recognize", _account_job(_recognize_job))
+queue.register("sticker", _account_job(_sticker_job))
+
+
+##### / Предзагрузка входящих медиа / #####
+# общий на все аккаунты запас трафика на предзагрузку, байт
+_prefetch_budget = rpc.TokenBucket(
+    config.prefetch_mb_per_hour * 1024 * 1024 / 3600,
+    config.prefetch_mb_per_hour * 1024 * 1024,
+)
+
+
+def _prefetch_kind(msg: types.Message) -> Optional[str]:
+    if msg.photo:
+        return "image"
+    if (msg.voice or msg.audio) and _is_transcoded_audio(msg):
+        return "audio"
+    return None
+
+
+@accounts.on(events.NewMessage(incoming=True))
+async def prefetch_media(event: events.NewMessage.Event):
+    """Заранее качает и перекодирует войсы и фото, чтобы открытие было из кеша.
+
+    Задачи идут с приоритетом PREFETCH (любой запрос пользователя их
+    обгоняет), не больше prefetch_pending в очереди и в пределах
+    prefetch_mb_per_hour трафика.
+    """
+    msg = event.message
+    if not config.prefetch_enabled or not msg.file:
+        return
+    if config.prefetch_chats and event.chat_id not in config.prefetch_chats:
+        return
+    if not (kind := _prefetch_kind(msg)):
+        return
+    size = msg.file.size or 0
+    if size > config.prefetch_max_mb * 1024 * 1024:
+        return
+    folder = f"{media.root}/{event.chat_id}/{msg.id}"
+    key = _job_key(kind, event.chat_id, msg.id)
+    # уже в кеше или в работе - бюджет не тратим
+    if utils.cached_file(folder) or key in queue.jobs:
+        return
+    pending = sum(j.priority == jobs.Priority.PREFETCH for j in queue.jobs.values())
+    if pending >= config.prefetch_pending or not _prefetch_budget.try_take(size):
+        return
+    os.makedirs(folder, exist_ok=True)
+    ext = config.audio_format if kind == "audio" else config.pic_format
+    queue.submit(
+        kind,
+        key,
+        jobs.Priority.PREFETCH,
+        account=accounts.current().name,
+        chat=event.chat_id,
+        msg_id=msg.id,
+        file=f"{folder}/{kind}.{ext}",
+    )
+
+
+def _job_page(job: jobs.Job, url: str, id: Union[int, str], **kwargs):
+    if job.error:
+        return HTMLResponse(
+            templates.get_template("error.html").render(error=job.error)
+        )
+    return HTMLResponse(
+        templates.get_template("processing.html").render(
+            url=url,
+            id=id,
+            stage=job.stage,
+            progress=int(job.progress * 100),
+            partial=job.partial,
+            **kwargs,
+        )
+    )
+
+
+@app.get("/jobs", description="Очередь обработки", response_class=HTMLResponse)
+async def jobs_list():
+    return templates.get_template("jobs.html").render(
+        jobs=[
+            job
+            for job in (*queue.jobs.values(), *reversed(queue.finished.values()))
+            if _own_job(job)
+        ],
+        priorities={p.value: p.name.lower() for p in jobs.Priority},
+    )
+
+
+@app.get("/jobs/{key}", description="Статус задачи")
+async def job_status(key: str):
+    if not (job := queue.get(key)) or not _own_job(job):
+        return JSONResponse({"state": "unknown"}, status_code=404)
+    return JSONResponse(
+        {
+            "kind": job.kind,
+            "state": job.state,
+            "stage": job.stage,
+            "progress": job.progress,
+            "partial": job.partial,
+            "priority": int(job.priority),
+            "error": job.error,
+        }
+    )
+
+
 ##### / Загрузка и стримминг файла из кеша / #####
+async def _hot_load(
+    key: str, file: str, media_type: str, fresh: bool
+) -> Optional[bytes]:
+    """Поднимает файл в память, если он только что записан или читается повторно"""
+    if not (fresh or media.hot.seen(key)) or not media.hot.fits(os.path.getsize(file)):
+        return None
+    data = await _in_thread(Path(file).read_bytes)
+    media.hot.put(key, mediacache.HotEntry(file, media_type, data))
+    return data
+
+
+async def _video(id: Union[int, str], msg: types.Message, original: bool):
+    # Видео отдаём ужатым: пока задача в очереди, показываем прогресс
+    folder = f"{media.root}/{id}/{msg.id}"
+    os.makedirs(folder, exist_ok=True)
+    if original:
+        file = f"{folder}/{msg.file.name or 'video' + (msg.file.ext or '')}"
+        if not os.path.isfile(file):
+            job = await queue.run(
+                "file",
+                _job_key("file", id, msg.id),
+                timeout=config.jobs_wait,
+                account=accounts.current().name,
+                chat=id,
+                msg_id=msg.id,
+                file=file,
+            )
+            if not job.done or job.error:
+                return _job_page(
+                    job, f"/chat/{id}/download/{msg.id}", id, original=True
+                )
+        media.touch(file)
+        return StreamingResponse(open(file, mode="rb"), media_type=msg.file.mime_type)
+    file = f"{folder}/video.{config.video_format}"
+    if os.path.isfile(file):
+        media.touch(file)
+        return StreamingResponse(
+            open(file, mode="rb"),
+            media_type=transcode.video_mime(config.video_format),
+        )
+    job = queue.submit(
+        "video",
+        _job_key("video", id, msg.id),
+        chat=id,
+        msg_id=msg.id,
+        file=file,
+        account=accounts.current().name,
+    )
+    return _job_page(job, f"/chat/{id}/download/{msg.id}", id, original=True)
+
+
+async def _sticker(id: Union[int, str], msg: types.Message):
+    # Стикер рисуется один раз на документ, а не на каждое сообщение с ним
+    folder = f"{media.root}/_stickers/{msg.sticker.id}"
+    file = f"{folder}/sticker.{config.pic_format}"
+    media_type = f"image/{config.pic_format}"
+    if hot := media.hot.get(folder):
+        metrics.cache_requests.inc("memory")
+        return Response(hot.data, media_type=hot.media_type)
+    fresh = not os.path.isfile(file)
+    metrics.cache_requests.inc("miss" if fresh else "hit")
+    if fresh:
+        os.makedirs(folder, exist_ok=True)
+        job = await queue.run(
+            "sticker",
+            _job_key("sticker", "_stickers", msg.sticker.id),
+            timeout=config.jobs_wait,
+            account=accounts.current().name,
+            chat=id,
+            msg_id=msg.id,
+            file=file,
+        )
+        if not job.done or job.error:
+            return _job_page(job, f"/chat/{id}/download/{msg.id}", id)
+    media.touch(file)
+    if (data := await _hot_load(folder, file, media_type, fresh)) is not None:
+        return Response(data, media_type=media_type)
+    return StreamingResponse(open(file, mode="rb"), media_type=media_type)
+
+
 @app.get("/chat/{id}/download/{msg_id}", description="Загрузка файла")
-async def download(id: str, msg_id: int):
+async def download(id: str, msg_id: int, original: bool = False):
     if not user.is_connected():
         await user.connect()
     if not await user.is_user_authorized():
@@ -398,7 +1623,14 @@ async def download(id: str, msg_id: int):
     try:
         with contextlib.suppress(Exception):
             id = int(id)
-        msg = await user.get_messages(id, ids=msg_id)
+        folder = f"{media.root}/{id}/{msg_id}"
+        # горячие мелкие файлы отдаются из памяти, даже без запроса сообщения
+        if not original and (hot := media.hot.get(folder)):
+            metrics.cache_requests.inc("memory")
+            media.touch(hot.file)
+            return Response(hot.data, media_type=hot.media_type)
+        with timing.span("get_messages"):
+            msg = await scheduler.get_messages(id, ids=msg_id)
         if not msg or not msg.file:
             return HTMLResponse(
                 templates.get_template("error.html").render(
@@ -406,35 +1638,76 @@ async def download(id: str, msg_id: int):
                 )
             )
         msg: types.Message
-        if (
-            os.path.isdir(f"cache/{id}/{msg_id}")
-            and os.listdir(f"cache/{id}/{msg_id}/") != []
-        ):
-            file = f"cache/{id}/{msg_id}/" + os.listdir(f"cache/{id}/{msg_id}/")[0]
+        media_type = msg.file.mime_type
+        if msg.sticker:
+            return await _sticker(id, msg)
+        if msg.file.mime_type.split("/")[0] == "video":
+            return await _video(id, msg, original)
+        fresh = False
+        if file := utils.cached_file(folder):
+            metrics.cache_requests.inc("hit")
+            if file.endswith(f"/audio.{config.audio_format}"):
+                media_type = transcode.audio_mime(config.audio_format)
+            elif file.endswith(f"/image.{config.pic_format}"):
+                media_type = f"image/{config.pic_format}"
         else:
-            for i in ["cache/", f"cache/{id}/", f"cache/{id}/{msg_id}/"]:
-                if not os.path.isdir(i):
-                    os.mkdir(i)
-            if msg.file.mime_type.split("/")[0] == "audio" and msg.file.ext != ".mp3":
-                file = f"cache/{id}/{msg_id}/audio.mp3"
-                m_ = io.BytesIO(await msg.download_media(bytes))
-                m_.name = "audio.wav"
-                AudioSegment.from_file(m_).export(file)
+            metrics.cache_requests.inc("miss")
+            fresh = True
+            os.makedirs(f"{folder}/", exist_ok=True)
+            if _is_transcoded_audio(msg):
+                file = f"{media.root}/{id}/{msg_id}/audio.{config.audio_format}"
+                media_type = transcode.audio_mime(config.audio_format)
+                if job := queue.jobs.get(_job_key("audio", id, msg_id)):
+                    # Уже перекодируется в фоне - дожидаемся этой задачи
+                    await queue.wait(job, config.jobs_wait)
+                    if not job.done or job.error:
+                        return _job_page(job, f"/chat/{id}/download/{msg_id}", id)
+                else:
+                    # Отдаём аудио по мере перекодирования, параллельно сохраняя в кеш
+                    return StreamingResponse(
+                        transcode.stream_audio(
+                            await _audio_source(msg, f"{media.root}/{id}/{msg_id}"),
+                            file,
+                            config.audio_format,
+                            config.audio_bitrate,
+                            # место в очереди - только пока работает ffmpeg
+                            slot=queue.slot(),
+                        ),
+                        media_type=media_type,
+                    )
             elif msg.file.mime_type.split("/")[0] == "image":
-                file = f"cache/{id}/{msg_id}/image.{config.pic_format}"
-                m_ = io.BytesIO(await msg.download_media(bytes))
-                m_.name = "pic.png"
-                im = Image.open(m_).convert("RGBA")
-                im.load()
-                bg = Image.new("RGB", im.size, (255,) * 3)
-                bg.paste(im, mask=im.split()[3])
-                bg.thumbnail((config.pic_max_size,) * 2, 1)
-                bg.save(file, config.pic_format, quality=config.pic_quality)
+                file = f"{media.root}/{id}/{msg_id}/image.{config.pic_format}"
+                media_type = f"image/{config.pic_format}"
+                job = await queue.run(
+                    "image",
+                    _job_key("image", id, msg_id),
+                    timeout=config.jobs_wait,
+                    account=accounts.current().name,
+                    chat=id,
+                    msg_id=msg_id,
+                    file=file,
+                )
+                if not job.done or job.error:
+                    return _job_page(job, f"/chat/{id}/download/{msg_id}", id)
             else:
-                path = f"cache/{id}/{msg_id}/{msg.file.name}"
-                file = await msg.download_media(path)
+                # большие файлы качаются задачей, пока она идёт - показываем прогресс
+                file = f"{folder}/{msg.file.name or 'file' + (msg.file.ext or '')}"
+                job = await queue.run(
+                    "file",
+                    _job_key("file", id, msg_id),
+                    timeout=config.jobs_wait,
+                    account=accounts.current().name,
+                    chat=id,
+                    msg_id=msg_id,
+                    file=file,
+                )
+                if not job.done or job.error:
+                    return _job_page(job, f"/chat/{id}/download/{msg_id}", id)
+        media.touch(file)
+        if (data := await _hot_load(folder, file, media_type, fresh)) is not None:
+            return Response(data, media_type=media_type)
         stream = open(file, mode="rb")
-        return StreamingResponse(stream, media_type=msg.file.mime_type)
+        return StreamingResponse(stream, media_type=media_type)
     except Exception as ex:
         return HTMLResponse(
             templates.get_template("error.html").render(error="<br>".join(ex.args))
@@ -450,45 +1723,21 @@ async def recognize(id: str, msg_id: int):  # sourcery skip: avoid-builtin-shado
     try:
         with contextlib.suppress(Exception):
             id = int(id)
-        msg = await user.get_messages(id, ids=msg_id)
-        if not msg or not msg.file:
-            return HTMLResponse(
-                templates.get_template("error.html").render(
-                    error="Такого сообщения не существует"
-                )
-            )
-        msg: types.Message
-        if (
-            os.path.isdir(f"cache/{id}/{msg_id}")
-            and os.listdir(f"cache/{id}/{msg_id}/") != []
-        ):
-            file = f"cache/{id}/{msg_id}/" + os.listdir(f"cache/{id}/{msg_id}/")[0]
-        else:
-            for i in ["cache/", f"cache/{id}/", f"cache/{id}/{msg_id}/"]:
-                if not os.path.isdir(i):
-                    os.mkdir(i)
-            if msg.file.mime_type.split("/")[0] == "audio" and msg.file.ext != ".mp3":
-                file = f"cache/{id}/{msg_id}/audio.mp3"
-                m_ = io.BytesIO(await msg.download_media(bytes))
-                m_.name = "audio.wav"
-                AudioSegment.from_file(m_).export(file)
-            else:
-                path = f"cache/{id}/{msg_id}/{msg.file.name}"
-                file = await msg.download_media(path)
-        if not os.path.isfile(f"{file}.wav"):
-            song = AudioSegment.from_file(file)
-            song.export(f"{file}.wav", format="wav")
-        r = sr.Recognizer()
-        with sr.AudioFile(f"{file}.wav") as source:
-            audio_data = r.record(source)
-            text = r.recognize_google(audio_data, language=config.recognize_lang)
-
-        r = sr.Recognizer()
-        with sr.AudioFile(f"{file}.wav") as source:
-            audio_data = r.record(source)
-            text = r.recognize_google(audio_data, language="ru-RU")
+        job = await queue.run(
+            "recognize",
+            _job_key("recognize", id, msg_id),
+            jobs.Priority.RECOGNIZE,
+            timeout=config.jobs_wait,
+            account=accounts.current().name,
+            chat=id,
+            msg_id=msg_id,
+        )
+        if not job.done or job.error:
+            return _job_page(job, f"/chat/{id}/recognize/{msg_id}", id)
         return HTMLResponse(
-            templates.get_template("voice_recognized.html").render(id=id, text=text)
+            templates.get_template("voice_recognized.html").render(
+                id=id, text=job.result
+            )
         )
     except Exception as ex:
         return HTMLResponse(
@@ -496,6 +1745,156 @@ async def recognize(id: str, msg_id: int):  # sourcery skip: avoid-builtin-shado
         )
 
 
+##### / JSON API v1 / #####
+async def _api_ready() -> Optional[Response]:
+    with contextlib.suppress(OSError):
+        if not user.is_connected():
+            await user.connect()
+    if not await user.is_user_authorized():
+        return api.error("Не авторизован", 401)
+    return None
+
+
+def _api_message(m: store.StoredMessage) -> models.ApiMessage:
+    media = None
+    if m.size is not None:
+        media = models.ApiMedia(
+            mime=m.mime,
+            name=m.filename,
+            size=m.size,
+            url=f"/chat/{m.chat}/download/{m.id}",
+        )
+    return models.ApiMessage(
+        id=m.id,
+        chat=m.chat,
+        sender=models.Peer(
+            id=m.sender_id or m.chat,
+            title=m.sender_title,
+            first_name=m.sender_first_name,
+        ),
+        text=m.raw_text or None,
+        reply_to=m.reply_to,
+        date=m.date,
+        out=m.out,
+        mentioned=m.mentioned,
+        media=media,
+    )
+
+
+@app.get("/api/v1/dialogs", description="API Список чатов")
+async def api_dialogs(
+    cursor: Optional[str] = None,
+    unread: bool = False,
+    archived: bool = False,
+    kind: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    if response := await _api_ready():
+        return response
+    try:
+        dialogs, next_cursor = await _dialogs_page(
+            cursor, unread, archived, kind if kind in DIALOG_KINDS else None
+        )
+    except Exception as ex:
+        return api.error("; ".join(map(str, ex.args)))
+    items = [
+        models.ApiDialog(
+            id=d.id,
+            title=d.title,
+            kind=_dialog_kind(d),
+            unread=d.unread_count,
+            mentions=d.unread_mentions_count,
+            pinned=d.pinned,
+            top_id=d.message.id if d.message else None,
+            date=int(d.date.timestamp()) if d.date else None,
+        )
+        for d in dialogs
+    ]
+    return api.page(items, next_cursor, api.parse_fields(fields))
+
+
+@app.get("/api/v1/chats/{id}/messages", description="API Сообщения чата")
+async def api_messages(
+    id: str,
+    cursor: Optional[int] = None,
+    limit: int = CHAT_PAGE,
+    fields: Optional[str] = None,
+):  # sourcery skip: avoid-builtin-shadow
+    """Сообщения новые первыми; курсор - id, старше которого читать дальше"""
+    if response := await _api_ready():
+        return response
+    try:
+        with contextlib.suppress(Exception):
+            id = int(id)
+        limit = max(1, min(limit, 100))
+        before = cursor or sys.maxsize
+        chat = await _open_chat(id)
+
+        async def enough() -> bool:
+            return len(await history.older(chat, before, limit)) >= limit
+
+        chat = await _refresh(chat, enough)
+        messages = await history.older(chat, before, limit)
+    except Exception as ex:
+        return api.error("; ".join(map(str, ex.args)))
+    more = len(messages) == limit or not chat.complete
+    next_cursor = str(messages[-1].id) if messages and more else None
+    return api.page(
+        [_api_message(m) for m in messages], next_cursor, api.parse_fields(fields)
+    )
+
+
+@app.get("/api/v1/chats/{id}/messages/{msg_id}", description="API Сообщение")
+async def api_message(id: str, msg_id: int, fields: Optional[str] = None):
+    # sourcery skip: avoid-builtin-shadow
+    if response := await _api_ready():
+        return response
+    try:
+        with contextlib.suppress(Exception):
+            id = int(id)
+        chat = await _open_chat(id)
+        m = (await history.get(chat.id, [msg_id])).get(msg_id)
+        if m is None:
+            if fetched := await scheduler.get_messages(chat.id, ids=msg_id):
+                m = store.StoredMessage.from_telethon(fetched, chat.id)
+                await history.put([m])
+    except Exception as ex:
+        return api.error("; ".join(map(str, ex.args)))
+    if m is None:
+        return api.error("Такого сообщения не существует", 404)
+    return api.item(_api_message(m), api.parse_fields(fields))
+
+
+@app.get("/api/v1/users/{id}", description="API Профиль пользователя")
+async def api_user(id: str, fields: Optional[str] = None):
+    # sourcery skip: avoid-builtin-shadow
+    if response := await _api_ready():
+        return response
+    tree = api.parse_fields(fields)
+    try:
+        with contextlib.suppress(Exception):
+            id = int(id)
+        entity = await scheduler.get_entity(id)
+        about = None
+        # полный профиль - отдельный запрос, делаем его только по просьбе
+        if isinstance(entity, types.User) and api.wants(tree, "about"):
+            about = (await scheduler.full_user(entity.id)).full_user.about
+    except Exception as ex:
+        return api.error("; ".join(map(str, ex.args)))
+    return api.item(
+        models.ApiUser(
+            id=entity.id,
+            first_name=getattr(entity, "first_name", None),
+            last_name=getattr(entity, "last_name", None),
+            username=getattr(entity, "username", None),
+            title=getattr(entity, "title", None),
+            bot=getattr(entity, "bot", None),
+            about=about,
+        ),
+        tree,
+    )
+
+
 ##### / Юзер / #####
 
 
@@ -508,14 +1907,24 @@ async def user_avatar(id: str):  # sourcery skip: avoid-builtin-shadow
     try:
         with contextlib.suppress(Exception):
             id = int(id)
-        user_ = await user.get_entity(id)
+        from PIL import Image
+
+        user_ = await scheduler.get_entity(id)
+        # аватарки только в памяти: ключ меняется вместе с photo_id
+        key = f"avatar:{user_.id}:{_photo_id(user_)}:{config.pic_avatar_max_size}"
+        media_type = f"image/{config.pic_format}"
+        if hot := media.hot.get(key):
+            metrics.cache_requests.inc("memory")
+            return Response(hot.data, media_type=hot.media_type)
         out = io.BytesIO()
         out.name = f"..{config.pic_format}"
-        im = Image.open(io.BytesIO(await user.download_profile_photo(user_, bytes)))
+        im = Image.open(
+            io.BytesIO(await scheduler.download_profile_photo(user_, bytes))
+        )
         im.thumbnail((config.pic_avatar_max_size,) * 2, 1)
         im.save(out, format=config.pic_format)
-        out.seek(0)
-        return StreamingResponse(out)
+        media.hot.put(key, mediacache.HotEntry(None, media_type, out.getvalue()))
+        return Response(out.getvalue(), media_type=media_type)
     except Exception as ex:
         return HTMLResponse(
             templates.get_template("error.html").render(error="<br>".join(ex.args))
@@ -531,8 +1940,8 @@ async def user_info(id: str):
     try:
         with contextlib.suppress(Exception):
             id = int(id)
-        user_ = await user.get_entity(id)
-        user_full = await user(functions.users.GetFullUserRequest(id=id))
+        user_ = await scheduler.get_entity(id)
+        user_full = await scheduler.full_user(id)
         statuses = {
             types.UserStatusEmpty: "Ничего",
             types.UserStatusOnline: "Онлайн",
@@ -560,26 +1969,68 @@ async def user_info(id: str):
 @app.get("/cache", description="Кеш", response_class=HTMLResponse)
 async def cache():
     try:
-        size = utils.humanize(utils.get_size("cache"))
+        size = utils.humanize(await media.size())
     except Exception:
         size = "0.0B"
-    return templates.get_template("cache.html").render(size=size)
+    return templates.get_template("cache.html").render(
+        size=size, hot=media.hot, humanize=utils.humanize
+    )
 
 
 @app.get("/cache/clear", description="Очистить кеш", response_class=HTMLResponse)
-async def cache_clear():
-    with contextlib.suppress(Exception):
-        utils.clear_dir("cache")
-    return RedirectResponse("/cache")
+async def cache_clear(
+    chat: Optional[str] = None,
+    type: Optional[str] = None,
+    days: Optional[str] = None,
+    mb: Optional[str] = None,
+):  # sourcery skip: avoid-builtin-shadow
+    try:
+        if not any((chat, type, days, mb)):
+            metrics.cache_evictions.inc(value=await media.clear())
+            return RedirectResponse("/cache")
+        count, size = await media.purge(
+            chat=chat or None,
+            kind=type or None,
+            older=float(days) * 86400 if days else None,
+            larger=int(float(mb) * 1024 * 1024) if mb else None,
+        )
+        metrics.cache_evictions.inc(value=count)
+        return templates.get_template("cache.html").render(
+            size=utils.humanize(await media.size()),
+            hot=media.hot,
+            humanize=utils.humanize,
+            msg=f"Удалено файлов: {count} ({utils.humanize(size)})",
+        )
+    except Exception as ex:
+        return templates.get_template("error.html").render(error="<br>".join(ex.args))
 
 
-@app.get("/cache/list", description="Дерево кеша", response_class=HTMLResponse)
-async def cache_list():
-    if not os.path.isdir("cache") or os.listdir("cache") == []:
-        return "Кеш пустой"
-    paths = utils.DisplayablePath.make_tree(Path("cache"))
-    var = "".join(path.displayable() + "\n" for path in paths)
-    return var.replace("\n", "<br>").replace(" ", " ")
+def _cache_page(template: str, items: list, page: int, **kwargs):
+    # Отдаём страницу по мере рендера, не собирая весь HTML в одну строку
+    size = config.cache_page_size
+    return StreamingResponse(
+        templates.get_template(template).generate(
+            items=items[page * size : (page + 1) * size],
+            page=page,
+            pages=(len(items) + size - 1) // size,
+            humanize=utils.humanize,
+            date=lambda t: time.strftime("%Y-%m-%d %H:%M", time.localtime(t)),
+            **kwargs,
+        ),
+        media_type="text/html",
+    )
+
+
+@app.get("/cache/list", description="Кеш по чатам", response_class=HTMLResponse)
+async def cache_list(page: int = 0):
+    return _cache_page("cache_list.html", await media.chats(), page)
+
+
+@app.get(
+    "/cache/list/{chat}", description="Файлы чата в кеше", response_class=HTMLResponse
+)
+async def cache_list_chat(chat: str, page: int = 0):
+    return _cache_page("cache_chat.html", await media.files(chat), page, chat=chat)
 
 
 @app.get("/about", description="О проекте", response_class=HTMLResponse)
@@ -0,0 +1,348 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import contextlib
+import glob
+import mimetypes
+import os
+import shutil
+import time
+from collections import OrderedDict
+from typing import *
+
+from pydantic import BaseModel
+
+# префикс корзин внутри каталога кеша
+TRASH = ".trash-"
+
+
+##### / Модели индекса / #####
+class CacheFile(BaseModel):
+    msg: str
+    name: str
+    size: int
+    atime: float
+
+
+class CacheChat(BaseModel):
+    chat: str
+    files: int = 0
+    size: int = 0
+    atime: float = 0.0
+
+
+class HotEntry(NamedTuple):
+    file: Optional[str]
+    media_type: str
+    data: bytes
+
+
+class HotCache:
+    """LRU в памяти перед дисковым кешем, ограниченный суммарным размером.
+
+    Ключ - папка сообщения в кеше (или любой другой стабильный ключ).
+    Файл попадает сюда сразу после записи либо при повторном чтении с
+    диска; объекты больше `max_item` байт не хранятся.
+    """
+
+    def __init__(self, max_bytes: int = 0, max_item: int = 0):
+        self.max_bytes = max_bytes
+        self.max_item = min(max_item, max_bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[str, HotEntry]" = OrderedDict()
+        # ключи, один раз прочитанные с диска
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key: str) -> Optional[HotEntry]:
+        if (entry := self._items.get(key)) is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def fits(self, size: int) -> bool:
+        return 0 < size <= self.max_item
+
+    def seen(self, key: str) -> bool:
+        """Отмечает чтение с диска; True, если оно повторное"""
+        if key in self._seen:
+            del self._seen[key]
+            return True
+        self._seen[key] = None
+        while len(self._seen) > 4096:
+            self._seen.popitem(last=False)
+        return False
+
+    def put(self, key: str, entry: HotEntry) -> bool:
+        if not self.fits(len(entry.data)):
+            return False
+        self.drop(key)
+        self._items[key] = entry
+        self.size += len(entry.data)
+        while self.size > self.max_bytes:
+            _, old = self._items.popitem(last=False)
+            self.size -= len(old.data)
+        return True
+
+    def drop(self, key: str):
+        if (old := self._items.pop(key, None)) is not None:
+            self.size -= len(old.data)
+
+    def drop_prefix(self, prefix: str):
+        for key in [k for k in self._items if k.startswith(prefix)]:
+            self.drop(key)
+
+    def clear(self):
+        self._items.clear()
+        self._seen.clear()
+        self.size = 0
+
+
+class MediaCache:
+    """Индекс файлового кеша `root/{chat}/{msg}/{file}`.
+
+    Строится один раз проходом `os.scandir` (по одному stat на файл) и далее
+    поддерживается при записи и чтении файлов, так что список кеша и его
+    размер не требуют обхода диска.
+    """
+
+    def __init__(self, root: str = "cache", hot_bytes: int = 0, hot_item: int = 0):
+        self.root = root
+        self.hot = HotCache(hot_bytes, hot_item)
+        self._index: Optional[Dict[str, Dict[str, Dict[str, CacheFile]]]] = None
+        self._lock = asyncio.Lock()
+
+    def _scan(self) -> Dict[str, Dict[str, Dict[str, CacheFile]]]:
+        index = {}
+        if not os.path.isdir(self.root):
+            return index
+        for chat in os.scandir(self.root):
+            if not chat.is_dir() or chat.name.startswith(TRASH):
+                continue
+            msgs = index[chat.name] = {}
+            for msg in os.scandir(chat.path):
+                if msg.is_dir():
+                    msgs[msg.name] = self._scan_msg(msg.path, msg.name)
+        return index
+
+    @staticmethod
+    def _scan_msg(path: str, msg: str) -> Dict[str, CacheFile]:
+        files = {}
+        for f in os.scandir(path):
+            if f.name.endswith(".part") or not f.is_file():
+                continue
+            st = f.stat()
+            files[f.name] = CacheFile(
+                msg=msg,
+                name=f.name,
+                size=st.st_size,
+                atime=max(st.st_atime, st.st_mtime),
+            )
+        return files
+
+    async def index(self) -> Dict[str, Dict[str, Dict[str, CacheFile]]]:
+        if self._index is None:
+            async with self._lock:
+                if self._index is None:
+                    self._index = await asyncio.get_event_loop().run_in_executor(
+                        None, self._scan
+                    )
+        return self._index
+
+    def reset(self):
+        self._index = None
+        self.hot.clear()
+
+    def touch(self, file: str):
+        """Отмечает обращение к файлу кеша, добавляя его в индекс при необходимости"""
+        if self._index is None:
+            return
+        parts = os.path.relpath(file, self.root).split(os.sep)
+        if len(parts) != 3:
+            return
+        chat, msg, name = parts
+        files = self._index.setdefault(chat, {}).setdefault(msg, {})
+        if name not in files:
+            files.update(self._scan_msg(os.path.dirname(file), msg))
+        if name in files:
+            files[name].atime = time.time()
+
+    def forget(self, chat: str, msg: Optional[str] = None):
+        if msg is None:
+            self.hot.drop_prefix(os.path.join(self.root, chat, ""))
+        else:
+            self.hot.drop(os.path.join(self.root, chat, msg))
+        if self._index is None:
+            return
+        if msg is None:
+            self._index.pop(chat, None)
+        elif chat in self._index:
+            self._index[chat].pop(msg, None)
+
+    def _trash(self) -> str:
+        return os.path.join(self.root, f"{TRASH}{time.time_ns()}")
+
+    @staticmethod
+    def _remove(paths: List[str]):
+        for path in paths:
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Failed to delete {path}. Reason: {e}")
+
+    def _background_remove(self, paths: List[str]):
+        if paths:
+            asyncio.get_event_loop().run_in_executor(None, self._remove, paths)
+
+    def sweep(self):
+        """Дочищает корзины, оставшиеся после прошлого запуска"""
+        self._background_remove(
+            glob.glob(os.path.join(glob.escape(self.root), f"{TRASH}*"))
+        )
+
+    def _move_to_trash(self) -> List[str]:
+        """Переносит содержимое кеша в корзину внутри него же.
+
+        Каталоги сообщений, где ещё пишется `.part`, не трогаются - из них
+        уносятся только готовые файлы, чтобы идущие загрузки и потоки смогли
+        переименовать результат на место. Возвращает пути для удаления:
+        корзину и то, что не удалось перенести.
+        """
+        trash = self._trash()
+        os.makedirs(trash)
+        left = []
+
+        def move(path: str, *name: str):
+            target = os.path.join(trash, *name)
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.rename(path, target)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                left.append(path)
+
+        for chat in os.scandir(self.root):
+            if chat.name.startswith(TRASH):
+                continue
+            if not chat.is_dir() or chat.is_symlink():
+                move(chat.path, chat.name)
+                continue
+            for msg in os.scandir(chat.path):
+                if not msg.is_dir() or msg.is_symlink():
+                    move(msg.path, chat.name, msg.name)
+                    continue
+                names = os.listdir(msg.path)
+                if not any(n.endswith(".part") for n in names):
+                    move(msg.path, chat.name, msg.name)
+                    continue
+                for name in names:
+                    if not name.endswith(".part"):
+                        move(os.path.join(msg.path, name), chat.name, msg.name, name)
+            with contextlib.suppress(OSError):
+                os.rmdir(chat.path)
+        return [trash, *left]
+
+    async def clear(self) -> int:
+        """Быстрая очистка: содержимое кеша переносится в корзину, а удаляется в фоне.
+
+        Возвращает число удалённых файлов.
+        """
+        count = sum(c.files for c in await self.chats())
+        self.hot.clear()
+        if not os.path.isdir(self.root):
+            return 0
+        loop = asyncio.get_event_loop()
+        try:
+            paths = await loop.run_in_executor(None, self._move_to_trash)
+        except OSError:
+            # корзину не создать (например, только чтение) - удаляем на месте
+            paths = [
+                e.path for e in os.scandir(self.root) if not e.name.startswith(TRASH)
+            ]
+        self._index = {}
+        self._background_remove(paths)
+        return count
+
+    @staticmethod
+    def kind(name: str) -> str:
+        mime = mimetypes.guess_type(name)[0] or ""
+        kind = mime.split("/")[0]
+        return kind if kind in ("audio", "image", "video") else "other"
+
+    async def purge(
+        self,
+        chat: Optional[str] = None,
+        kind: Optional[str] = None,
+        older: Optional[float] = None,
+        larger: Optional[int] = None,
+    ) -> Tuple[int, int]:
+        """Выборочно удаляет файлы: по чату, типу, давности обращения (сек) и размеру (байт).
+
+        Индекс обновляется сразу, сами файлы удаляются в фоне.
+        Возвращает число файлов и освобождённые байты.
+        """
+        index = await self.index()
+        now = time.time()
+        paths, size = [], 0
+        for c in [chat] if chat is not None else list(index):
+            msgs = index.get(c, {})
+            for msg, files in list(msgs.items()):
+                for name, f in list(files.items()):
+                    if kind and self.kind(name) != kind:
+                        continue
+                    if older is not None and now - f.atime < older:
+                        continue
+                    if larger is not None and f.size < larger:
+                        continue
+                    del files[name]
+                    self.hot.drop(os.path.join(self.root, c, msg))
+                    paths.append(os.path.join(self.root, c, msg, name))
+                    size += f.size
+                if not files:
+                    del msgs[msg]
+            if not msgs:
+                index.pop(c, None)
+        self._background_remove(paths)
+        return len(paths), size
+
+    async def chats(self) -> List[CacheChat]:
+        """Сводка по чатам, недавно использованные - первыми"""
+        result = []
+        for chat, msgs in (await self.index()).items():
+            agg = CacheChat(chat=chat)
+            for files in msgs.values():
+                for f in files.values():
+                    agg.files += 1
+                    agg.size += f.size
+                    agg.atime = max(agg.atime, f.atime)
+            if agg.files:
+                result.append(agg)
+        result.sort(key=lambda c: c.atime, reverse=True)
+        return result
+
+    async def files(self, chat: str) -> List[CacheFile]:
+        msgs = (await self.index()).get(chat, {})
+        result = [f for files in msgs.values() for f in files.values()]
+        result.sort(key=lambda f: f.atime, reverse=True)
+        return result
+
+    async def size(self) -> int:
+        return sum(c.size for c in await self.chats())
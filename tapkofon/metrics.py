@@ -0,0 +1,209 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import bisect
+import contextlib
+import threading
+import time
+from typing import *
+
+import rpc
+from telethon import TelegramClient, errors
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+##### / Метрики в формате Prometheus / #####
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, value: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, *labels: str, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, *labels: str, value: float):
+        with self._lock:
+            # счётчики по корзинам + сумма + количество
+            data = self._values.setdefault(labels, [0] * (len(self.buckets) + 3))
+            data[bisect.bisect_left(self.buckets, value)] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - start)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, data in sorted(self._values.items()):
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), data):
+                total += count
+                le = _labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {total}")
+            lbl = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{lbl} {data[-2]}")
+            lines.append(f"{self.name}_count{lbl} {data[-1]}")
+        return lines
+
+
+registry: List[_Metric] = []
+
+
+def render() -> str:
+    return "\n".join(line for m in registry for line in m.render()) + "\n"
+
+
+##### / Сами метрики / #####
+http_duration = Histogram(
+    "tapkofon_http_request_duration_seconds",
+    "Время обработки HTTP-запроса до начала ответа",
+    ("method", "route", "status"),
+)
+rpc_duration = Histogram(
+    "tapkofon_telegram_rpc_duration_seconds",
+    "Время выполнения запросов к Telegram",
+    ("request",),
+)
+rpc_errors = Counter(
+    "tapkofon_telegram_rpc_errors_total",
+    "Запросы к Telegram, завершившиеся ошибкой",
+    ("request", "error"),
+)
+floodwait = Counter(
+    "tapkofon_telegram_floodwait_total", "Полученные FloodWait", ("request",)
+)
+floodwait_seconds = Counter(
+    "tapkofon_telegram_floodwait_seconds_total",
+    "Суммарная длительность FloodWait",
+    ("request",),
+)
+cache_requests = Counter(
+    "tapkofon_media_cache_requests_total",
+    "Обращения к кешу медиа",
+    ("result",),
+)
+cache_evictions = Counter(
+    "tapkofon_media_cache_evictions_total", "Файлы, удалённые из кеша медиа"
+)
+transcode_duration = Histogram(
+    "tapkofon_transcode_duration_seconds",
+    "Время перекодирования медиа",
+    ("kind",),
+)
+recognize_duration = Histogram(
+    "tapkofon_recognize_duration_seconds", "Время распознавания речи"
+)
+loop_lag = Histogram(
+    "tapkofon_event_loop_lag_seconds",
+    "Задержка цикла событий",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+async def watch_loop_lag(interval: float = 0.5):
+    """Измеряет, насколько позже положенного просыпается цикл событий"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.observe(value=max(time.perf_counter() - start - interval, 0.0))
+
+
+##### / Клиент Telegram с метриками / #####
+class InstrumentedClient(TelegramClient):
+    """TelegramClient, считающий время, ошибки и FloodWait каждого запроса.
+
+    FloodWait ниже `flood_sleep_threshold` Telethon обычно пересыпает
+    молча, поэтому здесь это ожидание повторено явно, чтобы его учесть.
+    Для запросов из планировщика действует его порог (`rpc.flood_threshold`).
+    """
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        if flood_sleep_threshold is None:
+            flood_sleep_threshold = rpc.flood_threshold()
+        if flood_sleep_threshold is None:
+            flood_sleep_threshold = self.flood_sleep_threshold
+        name = type(request).__name__ if not isinstance(request, list) else "batch"
+        while True:
+            start = time.perf_counter()
+            try:
+                return await super()._call(
+                    sender, request, ordered=ordered, flood_sleep_threshold=0
+                )
+            except errors.FloodWaitError as e:
+                floodwait.inc(name)
+                floodwait_seconds.inc(name, value=e.seconds)
+                if e.seconds > flood_sleep_threshold:
+                    rpc_errors.inc(name, type(e).__name__)
+                    raise
+                await asyncio.sleep(e.seconds)
+            except Exception as e:
+                rpc_errors.inc(name, type(e).__name__)
+                raise
+            finally:
+                rpc_duration.observe(name, value=time.perf_counter() - start)
@@ -7,6 +7,12 @@ from pydantic import BaseModel
 
 
 ##### / Модели данных / #####
+class Peer(BaseModel):
+    id: int
+    title: Optional[str] = None
+    first_name: Optional[str] = None
+
+
 class Chat(BaseModel):
     id: int
     title: str
@@ -29,10 +35,57 @@ class ReplyMessage(BaseModel):
 
 class Message(BaseModel):
     id: int
-    sender: Any
+    sender: Peer
     text: Optional[str] = None
     file: Optional[MessageMedia] = None
     reply: Optional[ReplyMessage] = None
     mentioned: bool
     date: str
     out: bool
+
+
+class SearchResult(BaseModel):
+    chat: int
+    chat_title: Optional[str] = None
+    message: Message
+
+
+##### / JSON API / #####
+class ApiDialog(BaseModel):
+    id: int
+    title: Optional[str] = None
+    kind: str
+    unread: int = 0
+    mentions: int = 0
+    pinned: bool = False
+    top_id: Optional[int] = None
+    date: Optional[int] = None
+
+
+class ApiMedia(BaseModel):
+    mime: Optional[str] = None
+    name: Optional[str] = None
+    size: int
+    url: str
+
+
+class ApiMessage(BaseModel):
+    id: int
+    chat: int
+    sender: Peer
+    text: Optional[str] = None
+    reply_to: Optional[int] = None
+    date: int
+    out: bool = False
+    mentioned: bool = False
+    media: Optional[ApiMedia] = None
+
+
+class ApiUser(BaseModel):
+    id: int
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    username: Optional[str] = None
+    title: Optional[str] = None
+    bot: Optional[bool] = None
+    about: Optional[str] = None
@@ -0,0 +1,229 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import contextlib
+import contextvars
+import time
+from collections import OrderedDict
+from enum import IntEnum
+from typing import *
+
+from telethon import errors, functions
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # загрузка страницы
+    BACKGROUND = 1  # фоновые задачи
+
+
+_priority: "contextvars.ContextVar[Priority]" = contextvars.ContextVar(
+    "rpc_priority", default=Priority.INTERACTIVE
+)
+
+
+# порог FloodWait текущего запроса; задаёт только планировщик
+_flood_threshold: "contextvars.ContextVar[Optional[int]]" = contextvars.ContextVar(
+    "rpc_flood_threshold", default=None
+)
+
+
+def flood_threshold() -> Optional[int]:
+    """Порог FloodWait для запроса из планировщика, None - порог клиента"""
+    return _flood_threshold.get()
+
+
+@contextlib.contextmanager
+def background():
+    """Запросы внутри блока уступают место запросам страниц"""
+    token = _priority.set(Priority.BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class Paused(Exception):
+    """Класс методов стоит на FloodWait, а устаревших данных нет"""
+
+    def __init__(self, cls: str, seconds: float):
+        self.cls = cls
+        self.seconds = seconds
+        tm = time.strftime("%Hh:%Mm:%Ss", time.gmtime(seconds))
+        super().__init__(f"Флудвейт! Подождите {tm}")
+
+
+def _freeze(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.interactive_waiting = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def pause_left(self) -> float:
+        return max(self.paused_until - time.monotonic(), 0.0)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def try_take(self, amount: float) -> bool:
+        """Забирает `amount` без ожидания; False, если запаса не хватает"""
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    async def acquire(self, priority: Priority, cls: str):
+        interactive = priority == Priority.INTERACTIVE
+        if interactive:
+            self.interactive_waiting += 1
+        try:
+            while True:
+                if left := self.pause_left:
+                    if interactive:
+                        raise Paused(cls, left)
+                    await asyncio.sleep(left)
+                    continue
+                self._refill()
+                # фоновые запросы ждут, пока в очереди есть интерактивные
+                if self.tokens >= 1 and (interactive or not self.interactive_waiting):
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max((1 - self.tokens) / self.rate, 0.01))
+        finally:
+            if interactive:
+                self.interactive_waiting -= 1
+
+
+class Scheduler:
+    """Единая точка вызовов Telegram поверх клиента.
+
+    - лимиты токен-бакетами по классам методов (messages, entity, ...);
+    - одинаковые одновременные запросы склеиваются в один;
+    - FloodWait ставит класс методов на паузу, пока она идёт, страницы
+      получают последний успешный ответ на тот же запрос (если он есть);
+    - запросы страниц идут вперёд фоновых (см. `background()`).
+
+    FloodWait выше `flood_sleep_threshold` не пересыпается клиентом, а сразу
+    доходит сюда. Прочие вызовы клиента (отправка, загрузки) живут с его
+    собственным порогом.
+    """
+
+    def __init__(
+        self,
+        client,
+        limits: Dict[str, Sequence[float]],
+        stale_size: int = 512,
+        flood_sleep_threshold: int = 0,
+    ):
+        self.client = client
+        self.limits = limits
+        self.flood_sleep_threshold = flood_sleep_threshold
+        self.buckets = {cls: TokenBucket(*limit) for cls, limit in limits.items()}
+        self.stale_size = stale_size
+        self._stale: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def _bucket(self, cls: str) -> TokenBucket:
+        if cls not in self.buckets:
+            self.buckets[cls] = TokenBucket(*self.limits.get("other", (5, 10)))
+        return self.buckets[cls]
+
+    def _remember(self, key: Hashable, result: Any):
+        self._stale[key] = result
+        self._stale.move_to_end(key)
+        while len(self._stale) > self.stale_size:
+            self._stale.popitem(last=False)
+
+    async def call(
+        self,
+        cls: str,
+        key: Optional[Hashable],
+        factory: Callable[[], Awaitable],
+        remember: bool = True,
+    ):
+        if key is not None:
+            try:
+                hash(key)
+            except TypeError:
+                key = None
+        if key is not None and key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+        bucket = self._bucket(cls)
+        priority = _priority.get()
+        if key is not None and bucket.pause_left and key in self._stale:
+            if priority == Priority.INTERACTIVE:
+                return self._stale[key]
+        fut = asyncio.ensure_future(
+            self._run(cls, key if remember else None, factory, priority)
+        )
+        if key is not None:
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(fut)
+
+    async def _run(self, cls, key, factory, priority):
+        bucket = self._bucket(cls)
+        while True:
+            await bucket.acquire(priority, cls)
+            token = _flood_threshold.set(self.flood_sleep_threshold)
+            try:
+                result = await factory()
+            except errors.FloodWaitError as e:
+                bucket.pause(e.seconds)
+                if priority == Priority.INTERACTIVE:
+                    if key is not None and key in self._stale:
+                        return self._stale[key]
+                    raise Paused(cls, e.seconds) from e
+                continue
+            finally:
+                _flood_threshold.reset(token)
+            if key is not None:
+                self._remember(key, result)
+            return result
+
+    ##### / Обёртки методов клиента / #####
+    def _method(self, cls: str, name: str, *args, remember: bool = True, **kwargs):
+        key = (
+            name,
+            tuple(_freeze(a) for a in args),
+            tuple(sorted((k, _freeze(v)) for k, v in kwargs.items())),
+        )
+        return self.call(
+            cls, key, lambda: getattr(self.client, name)(*args, **kwargs), remember
+        )
+
+    def get_messages(self, *args, **kwargs):
+        return self._method("messages", "get_messages", *args, **kwargs)
+
+    def get_entity(self, *args, **kwargs):
+        return self._method("entity", "get_entity", *args, **kwargs)
+
+    def get_dialogs(self, *args, **kwargs):
+        return self._method("dialogs", "get_dialogs", *args, **kwargs)
+
+    def download_profile_photo(self, *args, **kwargs):
+        # файлы склеиваем, но не храним как устаревшие данные
+        return self._method(
+            "files", "download_profile_photo", *args, remember=False, **kwargs
+        )
+
+    def full_user(self, id):
+        return self.call(
+            "entity",
+            ("GetFullUserRequest", id),
+            lambda: self.client(functions.users.GetFullUserRequest(id=id)),
+        )
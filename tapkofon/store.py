@@ -0,0 +1,426 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import *
+
+from pydantic import BaseModel
+
+# Копия сообщений - это кеш: при смене схемы база просто строится заново
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    first_name TEXT,
+    low INTEGER,
+    high INTEGER,
+    complete INTEGER NOT NULL DEFAULT 0,
+    live INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    chat INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    sender_id INTEGER,
+    sender_title TEXT,
+    sender_first_name TEXT,
+    text TEXT,
+    raw_text TEXT,
+    reply_to INTEGER,
+    mentioned INTEGER NOT NULL DEFAULT 0,
+    out INTEGER NOT NULL DEFAULT 0,
+    date INTEGER NOT NULL,
+    mime TEXT,
+    filename TEXT,
+    size INTEGER,
+    PRIMARY KEY (chat, id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    raw_text,
+    content = 'messages',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, raw_text) VALUES (new.rowid, new.raw_text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, raw_text)
+        VALUES ('delete', old.rowid, old.raw_text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, raw_text)
+        VALUES ('delete', old.rowid, old.raw_text);
+    INSERT INTO messages_fts (rowid, raw_text) VALUES (new.rowid, new.raw_text);
+END;
+-- версия чата меняется с любым изменением его сообщений (для ETag)
+CREATE TRIGGER IF NOT EXISTS messages_version_insert AFTER INSERT ON messages BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = new.chat;
+END;
+CREATE TRIGGER IF NOT EXISTS messages_version_delete AFTER DELETE ON messages BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = old.chat;
+END;
+CREATE TRIGGER IF NOT EXISTS messages_version_update AFTER UPDATE ON messages BEGIN
+    UPDATE chats SET version = version + 1 WHERE id = new.chat;
+END;
+"""
+DROP_SCHEMA = """
+DROP TABLE IF EXISTS messages_fts;
+DROP TABLE IF EXISTS messages;
+DROP TABLE IF EXISTS chats;
+"""
+MESSAGE_COLUMNS = (
+    "chat",
+    "id",
+    "sender_id",
+    "sender_title",
+    "sender_first_name",
+    "text",
+    "raw_text",
+    "reply_to",
+    "mentioned",
+    "out",
+    "date",
+    "mime",
+    "filename",
+    "size",
+)
+
+# id каналов и супергрупп в формате Telethon: -100xxxxxxxxxx
+CHANNEL_ID_BOUND = -1000000000000
+
+
+##### / Модели хранилища / #####
+class StoredChat(BaseModel):
+    id: int
+    title: Optional[str] = None
+    first_name: Optional[str] = None
+    low: Optional[int] = None
+    high: Optional[int] = None
+    complete: bool = False
+    live: bool = False
+    version: int = 0
+
+    @property
+    def covered(self) -> bool:
+        return self.low is not None
+
+
+class StoredMessage(BaseModel):
+    chat: int
+    id: int
+    sender_id: Optional[int] = None
+    sender_title: Optional[str] = None
+    sender_first_name: Optional[str] = None
+    text: Optional[str] = None
+    raw_text: Optional[str] = None
+    reply_to: Optional[int] = None
+    mentioned: bool = False
+    out: bool = False
+    date: int
+    mime: Optional[str] = None
+    filename: Optional[str] = None
+    size: Optional[int] = None
+
+    @classmethod
+    def from_telethon(cls, m, chat: Optional[int] = None) -> "StoredMessage":
+        sender = m.sender
+        file = m.file
+        return cls(
+            chat=chat if chat is not None else m.chat_id,
+            id=m.id,
+            sender_id=m.sender_id,
+            sender_title=getattr(sender, "title", None),
+            sender_first_name=getattr(sender, "first_name", None),
+            text=m.text or None,
+            raw_text=m.raw_text or None,
+            reply_to=m.reply_to_msg_id,
+            mentioned=bool(m.mentioned),
+            out=bool(m.out),
+            date=int(m.date.timestamp()),
+            mime=file.mime_type if file else None,
+            filename=file.name if file else None,
+            size=file.size if file else None,
+        )
+
+
+class MessageStore:
+    """Локальная копия сообщений в SQLite.
+
+    Наполняется событиями Telethon и догрузкой истории. Для каждого чата
+    хранится покрытый диапазон id `[low, high]`: сообщения внутри него
+    скопированы без пропусков, и страницы чата строятся только из него.
+    `live` означает, что с момента последней сверки с Telegram клиент был
+    на связи и события приходили - иначе перед показом сверяется начало чата.
+
+    Все запросы идут через один поток, соединение с базой живёт в нём.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="tapkofon-store")
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            # REPLACE должен запускать триггер удаления из полнотекстового индекса
+            self._db.execute("PRAGMA recursive_triggers=ON")
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._db.executescript(DROP_SCHEMA)
+                self._db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _run(self, func: Callable, *args) -> Awaitable:
+        return asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def close(self):
+        """Закрывает базу и поток; после этого объект больше не используется"""
+        await self._run(self._close)
+        self._executor.shutdown(wait=False)
+
+    ##### / Чаты / #####
+    def _chat(self, chat: int) -> Optional[StoredChat]:
+        row = self._conn().execute("SELECT * FROM chats WHERE id = ?", (chat,))
+        row = row.fetchone()
+        return StoredChat(**row) if row else None
+
+    def chat(self, chat: int) -> Awaitable[Optional[StoredChat]]:
+        return self._run(self._chat, chat)
+
+    def _save_chat(self, chat: StoredChat):
+        with self._conn() as db:
+            # version ведут триггеры, поэтому её не перезаписываем
+            db.execute(
+                "INSERT INTO chats (id, title, first_name, low, high, complete, live) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                "title = excluded.title, first_name = excluded.first_name, "
+                "low = excluded.low, high = excluded.high, "
+                "complete = excluded.complete, live = excluded.live",
+                (
+                    chat.id,
+                    chat.title,
+                    chat.first_name,
+                    chat.low,
+                    chat.high,
+                    int(chat.complete),
+                    int(chat.live),
+                ),
+            )
+
+    def save_chat(self, chat: StoredChat) -> Awaitable[None]:
+        return self._run(self._save_chat, chat)
+
+    def _chats(self, ids: List[int]) -> Dict[int, StoredChat]:
+        marks = ",".join("?" * len(ids))
+        rows = self._conn().execute(f"SELECT * FROM chats WHERE id IN ({marks})", ids)
+        return {row["id"]: StoredChat(**row) for row in rows}
+
+    def chats(self, ids: List[int]) -> Awaitable[Dict[int, StoredChat]]:
+        return self._run(self._chats, ids)
+
+    def _name_chat(self, chat: StoredChat):
+        with self._conn() as db:
+            db.execute(
+                "INSERT OR IGNORE INTO chats (id, title, first_name) VALUES (?, ?, ?)",
+                (chat.id, chat.title, chat.first_name),
+            )
+
+    def name_chat(self, chat: StoredChat) -> Awaitable[None]:
+        """Запоминает название чата, не трогая покрытие уже известных чатов"""
+        return self._run(self._name_chat, chat)
+
+    def _stale(self):
+        with self._conn() as db:
+            db.execute("UPDATE chats SET live = 0")
+
+    def stale(self) -> Awaitable[None]:
+        """Помечает все чаты несверенными (перезапуск, обрыв связи)"""
+        return self._run(self._stale)
+
+    ##### / Сообщения / #####
+    def _put(self, messages: List[StoredMessage]):
+        with self._conn() as db:
+            db.executemany(
+                f"INSERT OR REPLACE INTO messages ({', '.join(MESSAGE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(MESSAGE_COLUMNS))})",
+                [tuple(getattr(m, c) for c in MESSAGE_COLUMNS) for m in messages],
+            )
+
+    def put(self, messages: List[StoredMessage]) -> Awaitable[None]:
+        return self._run(self._put, messages)
+
+    def _live_message(self, message: StoredMessage):
+        # Новое сообщение продлевает покрытие только у сверенных чатов,
+        # иначе между high и ним может быть пропуск
+        self._put([message])
+        with self._conn() as db:
+            db.execute(
+                "UPDATE chats SET high = ? WHERE id = ? AND live = 1 AND high < ?",
+                (message.id, message.chat, message.id),
+            )
+
+    def live_message(self, message: StoredMessage) -> Awaitable[None]:
+        return self._run(self._live_message, message)
+
+    def _delete(self, chat: Optional[int], ids: List[int]):
+        marks = ",".join("?" * len(ids))
+        with self._conn() as db:
+            if chat is not None:
+                db.execute(
+                    f"DELETE FROM messages WHERE chat = ? AND id IN ({marks})",
+                    (chat, *ids),
+                )
+            else:
+                # В личках и обычных группах id сквозные по аккаунту, и
+                # Telegram не сообщает чат удалённых сообщений
+                db.execute(
+                    f"DELETE FROM messages WHERE chat > ? AND id IN ({marks})",
+                    (CHANNEL_ID_BOUND, *ids),
+                )
+
+    def delete(self, chat: Optional[int], ids: List[int]) -> Awaitable[None]:
+        return self._run(self._delete, chat, ids)
+
+    def _sync(self, chat: int, low: int, high: int, messages: List[StoredMessage]):
+        """Заменяет диапазон id `[low, high]` свежим ответом Telegram"""
+        with self._conn() as db:
+            db.execute(
+                "DELETE FROM messages WHERE chat = ? AND id BETWEEN ? AND ?",
+                (chat, low, high),
+            )
+        self._put(messages)
+
+    def sync(
+        self, chat: int, low: int, high: int, messages: List[StoredMessage]
+    ) -> Awaitable[None]:
+        return self._run(self._sync, chat, low, high, messages)
+
+    def _page(self, chat: StoredChat, limit: int, offset: int) -> List[StoredMessage]:
+        if not chat.covered:
+            return []
+        rows = self._conn().execute(
+            "SELECT * FROM messages WHERE chat = ? AND id BETWEEN ? AND ? "
+            "ORDER BY id DESC LIMIT ? OFFSET ?",
+            (chat.id, chat.low, chat.high, limit, offset),
+        )
+        return [StoredMessage(**row) for row in rows]
+
+    def page(
+        self, chat: StoredChat, limit: int, offset: int = 0
+    ) -> Awaitable[List[StoredMessage]]:
+        return self._run(self._page, chat, limit, offset)
+
+    def _newer(self, chat: StoredChat, after: int, limit: int) -> List[StoredMessage]:
+        if not chat.covered:
+            return []
+        rows = self._conn().execute(
+            "SELECT * FROM messages WHERE chat = ? AND id > ? AND id BETWEEN ? AND ? "
+            "ORDER BY id DESC LIMIT ?",
+            (chat.id, after, chat.low, chat.high, limit),
+        )
+        return [StoredMessage(**row) for row in rows]
+
+    def newer(
+        self, chat: StoredChat, after: int, limit: int
+    ) -> Awaitable[List[StoredMessage]]:
+        """Сообщения покрытого диапазона новее `after`, новые первыми"""
+        return self._run(self._newer, chat, after, limit)
+
+    def _older(self, chat: StoredChat, before: int, limit: int) -> List[StoredMessage]:
+        if not chat.covered:
+            return []
+        rows = self._conn().execute(
+            "SELECT * FROM messages WHERE chat = ? AND id < ? AND id BETWEEN ? AND ? "
+            "ORDER BY id DESC LIMIT ?",
+            (chat.id, before, chat.low, chat.high, limit),
+        )
+        return [StoredMessage(**row) for row in rows]
+
+    def older(
+        self, chat: StoredChat, before: int, limit: int
+    ) -> Awaitable[List[StoredMessage]]:
+        """Сообщения покрытого диапазона старше `before`, новые первыми"""
+        return self._run(self._older, chat, before, limit)
+
+    def _count(self, chat: StoredChat) -> int:
+        if not chat.covered:
+            return 0
+        return (
+            self._conn()
+            .execute(
+                "SELECT COUNT(*) FROM messages WHERE chat = ? AND id BETWEEN ? AND ?",
+                (chat.id, chat.low, chat.high),
+            )
+            .fetchone()[0]
+        )
+
+    def count(self, chat: StoredChat) -> Awaitable[int]:
+        return self._run(self._count, chat)
+
+    def _get(self, chat: int, ids: List[int]) -> Dict[int, StoredMessage]:
+        marks = ",".join("?" * len(ids))
+        rows = self._conn().execute(
+            f"SELECT * FROM messages WHERE chat = ? AND id IN ({marks})", (chat, *ids)
+        )
+        return {row["id"]: StoredMessage(**row) for row in rows}
+
+    def get(self, chat: int, ids: List[int]) -> Awaitable[Dict[int, StoredMessage]]:
+        return self._run(self._get, chat, ids)
+
+    ##### / Поиск / #####
+    def _search(
+        self,
+        query: str,
+        chat: Optional[int],
+        before: Optional[Tuple[int, int, int]],
+        limit: int,
+    ) -> List[StoredMessage]:
+        # Ищем только в покрытых диапазонах: всё остальное дополняет Telegram
+        sql = (
+            "SELECT m.* FROM messages_fts f "
+            "JOIN messages m ON m.rowid = f.rowid "
+            "JOIN chats c ON c.id = m.chat "
+            "WHERE messages_fts MATCH ? AND m.id BETWEEN c.low AND c.high"
+        )
+        params: List[Any] = [fts_query(query)]
+        if chat is not None:
+            sql += " AND m.chat = ?"
+            params.append(chat)
+        if before is not None:
+            sql += " AND (m.date, m.chat, m.id) < (?, ?, ?)"
+            params.extend(before)
+        sql += " ORDER BY m.date DESC, m.chat DESC, m.id DESC LIMIT ?"
+        params.append(limit)
+        return [StoredMessage(**row) for row in self._conn().execute(sql, params)]
+
+    def search(
+        self,
+        query: str,
+        chat: Optional[int] = None,
+        before: Optional[Tuple[int, int, int]] = None,
+        limit: int = 20,
+    ) -> Awaitable[List[StoredMessage]]:
+        """Полнотекстовый поиск, новые сообщения первыми.
+
+        `before` - курсор `(date, chat, id)` последнего показанного результата.
+        """
+        return self._run(self._search, query, chat, before, limit)
+
+
+def fts_query(query: str) -> str:
+    """Превращает ввод пользователя в запрос FTS5: все слова, по префиксу"""
+    words = query.split()
+    return " ".join('"{}"*'.format(w.replace('"', '""')) for w in words) or '""'
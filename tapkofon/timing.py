@@ -0,0 +1,104 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import collections
+import contextlib
+import contextvars
+import os
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import *
+
+# имя фазы -> [суммарное время, число замеров]
+_spans: "contextvars.ContextVar[Optional[Dict[str, List[float]]]]" = (
+    contextvars.ContextVar("spans", default=None)
+)
+
+
+##### / Server-Timing / #####
+def start():
+    """Начинает сбор фаз для текущего запроса"""
+    _spans.set({})
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """Замеряет фазу запроса; повторные замеры с тем же именем суммируются"""
+    spans = _spans.get()
+    if spans is None:
+        yield
+        return
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        stat = spans.setdefault(name, [0.0, 0])
+        stat[0] += time.perf_counter() - begin
+        stat[1] += 1
+
+
+def header(total: float) -> str:
+    parts = []
+    for name, (dur, count) in (_spans.get() or {}).items():
+        part = f"{name};dur={dur * 1000:.1f}"
+        if count > 1:
+            part += f';desc="x{count}"'
+        parts.append(part)
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+##### / Сэмплирующий профилировщик / #####
+class Sampler(threading.Thread):
+    """Периодически снимает стек потока цикла событий.
+
+    Сэмплы хранятся в кольцевом буфере за последние `window` секунд; для
+    медленного запроса из него вырезается интервал запроса и сохраняется
+    в формате collapsed stacks (flamegraph.pl, speedscope, inferno).
+    Все запросы делят один поток, поэтому в профиль попадает и работа
+    параллельных запросов.
+    """
+
+    def __init__(self, folder: Path, interval: float = 0.005, window: float = 60.0):
+        super().__init__(name="tapkofon-sampler", daemon=True)
+        self.folder = folder
+        self.interval = interval
+        self.target = threading.get_ident()
+        self.samples: Deque[Tuple[float, Tuple[str, ...]]] = collections.deque(
+            maxlen=int(window / interval)
+        )
+
+    @staticmethod
+    def _stack(frame) -> Tuple[str, ...]:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def run(self):
+        while True:
+            frame = sys._current_frames().get(self.target)
+            if frame is not None:
+                self.samples.append((time.perf_counter(), self._stack(frame)))
+            time.sleep(self.interval)
+
+    def dump(self, begin: float, end: float, name: str) -> Optional[Path]:
+        stacks = collections.Counter(
+            stack for ts, stack in list(self.samples) if begin <= ts <= end
+        )
+        if not stacks:
+            return None
+        self.folder.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r"[^\w.-]+", "_", name).strip("_") or "root"
+        path = self.folder / f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}.folded"
+        with path.open("w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+        return path
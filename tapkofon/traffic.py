@@ -0,0 +1,200 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+"""Экономия трафика: сжатие ответов (gzip/brotli) и минификация шаблонов.
+
+Модуль не назван `compression`: в Python 3.14 так называется пакет
+стандартной библиотеки, который импортирует gzip, и наш модуль из
+каталога приложения перекрыл бы его.
+"""
+
+import re
+import zlib
+from typing import *
+
+from jinja2 import FileSystemLoader
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен, без него отдаём только gzip
+    brotli = None
+
+# Всё остальное (картинки, аудио, видео, архивы) уже сжато
+COMPRESSIBLE = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+
+##### / Сжатие ответов / #####
+def _accepted(scope) -> Set[str]:
+    for name, value in scope["headers"]:
+        if name == b"accept-encoding":
+            result = set()
+            for token in value.decode("latin-1").lower().split(","):
+                coding, *params = (p.strip() for p in token.split(";"))
+                if not any(p.replace(" ", "") in ("q=0", "q=0.0") for p in params):
+                    result.add(coding)
+            return result
+    return set()
+
+
+class _Gzip:
+    def __init__(self, level: int):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, data: bytes, more: bool) -> bytes:
+        return self._obj.compress(data) + self._obj.flush(
+            zlib.Z_SYNC_FLUSH if more else zlib.Z_FINISH
+        )
+
+
+class _Brotli:
+    def __init__(self, quality: int):
+        self._obj = brotli.Compressor(quality=quality)
+
+    def process(self, data: bytes, more: bool) -> bytes:
+        out = self._obj.process(data)
+        return out + (self._obj.flush() if more else self._obj.finish())
+
+
+class CompressionMiddleware:
+    """ASGI-сжатие ответов: brotli, если клиент его принимает, иначе gzip.
+
+    Ответы меньше `minimum_size`, медиа и уже сжатые ответы уходят как есть.
+    Потоковые ответы сжимаются по частям, с flush после каждой, чтобы
+    страница продолжала появляться постепенно.
+    """
+
+    def __init__(
+        self,
+        app,
+        minimum_size: int = 512,
+        gzip_level: int = 6,
+        brotli_quality: int = 5,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accepted = _accepted(scope)
+        if brotli is not None and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in accepted:
+            encoding = "gzip"
+        else:
+            return await self.app(scope, receive, send)
+
+        start: Optional[dict] = None
+        buffer = b""
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, buffer, compressor, passthrough
+            if message["type"] == "http.response.start":
+                headers = {k.lower(): v for k, v in message.get("headers", [])}
+                ctype = headers.get(b"content-type", b"").decode("latin-1")
+                passthrough = (
+                    b"content-encoding" in headers
+                    or message["status"] in (204, 304)
+                    or not ctype.startswith(COMPRESSIBLE)
+                )
+                if passthrough:
+                    await send(message)
+                else:
+                    start = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                return await send(message)
+
+            more = message.get("more_body", False)
+            if compressor is None:
+                buffer += message.get("body", b"")
+                if more and len(buffer) < self.minimum_size:
+                    return
+                if not more and len(buffer) < self.minimum_size:
+                    start["headers"] = _vary(start.get("headers", []))
+                    await send(start)
+                    return await send({"type": "http.response.body", "body": buffer})
+                compressor = (
+                    _Brotli(self.brotli_quality)
+                    if encoding == "br"
+                    else _Gzip(self.gzip_level)
+                )
+                headers = [
+                    (k, v)
+                    for k, v in _vary(start.get("headers", []))
+                    if k.lower() != b"content-length"
+                ]
+                headers.append((b"content-encoding", encoding.encode()))
+                if not more:
+                    body = compressor.process(buffer, False)
+                    headers.append((b"content-length", str(len(body)).encode()))
+                    start["headers"] = headers
+                    await send(start)
+                    return await send({"type": "http.response.body", "body": body})
+                start["headers"] = headers
+                await send(start)
+                data, buffer = buffer, b""
+            else:
+                data = message.get("body", b"")
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": compressor.process(data, more),
+                    "more_body": more,
+                }
+            )
+
+        await self.app(scope, receive, send_compressed)
+
+
+def _vary(headers: List[Tuple[bytes, bytes]]) -> List[Tuple[bytes, bytes]]:
+    for k, v in headers:
+        if k.lower() == b"vary" and b"accept-encoding" in v.lower():
+            return list(headers)
+    return [*headers, (b"vary", b"Accept-Encoding")]
+
+
+##### / Минификация шаблонов / #####
+_HTML_COMMENT = re.compile(r"<!--(?!\[).*?-->", re.S)
+_JINJA_COMMENT = re.compile(r"\{#.*?#\}", re.S)
+_BLOCK_LINE = re.compile(r"(\{%.*?%\})+")
+
+
+def minify_html(source: str) -> str:
+    """Убирает из исходника шаблона комментарии, отступы и пустые строки.
+
+    Переводы строк между строками с текстом сохраняются, поэтому пробелы
+    между строчными элементами и построчные комментарии в <script> не
+    ломаются. Строки из одних тегов `{% %}` склеиваются со следующей, чтобы
+    не оставлять в выводе пустых строк.
+    """
+    source = _JINJA_COMMENT.sub("", _HTML_COMMENT.sub("", source))
+    out = []
+    for line in source.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        out.append(line if _BLOCK_LINE.fullmatch(line) else line + "\n")
+    return "".join(out)
+
+
+class MinifyingLoader(FileSystemLoader):
+    """Загрузчик шаблонов с минификацией исходника.
+
+    Jinja кеширует скомпилированный шаблон, так что минификация выполняется
+    один раз при загрузке (и после изменения файла), а не на каждый запрос.
+    """
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        return minify_html(source), filename, uptodate
@@ -0,0 +1,298 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import contextlib
+import os
+import secrets
+from typing import *
+
+import metrics
+
+##### / Форматы / #####
+# формат -> (аргументы кодека ffmpeg, mime-тип)
+AUDIO_FORMATS = {
+    "mp3": (["-c:a", "libmp3lame", "-ac", "1"], "audio/mpeg"),
+    "amr": (["-c:a", "libopencore_amrnb", "-ac", "1", "-ar", "8000"], "audio/amr"),
+}
+
+# формат -> (аргументы контейнера ffmpeg, mime-тип)
+VIDEO_FORMATS = {
+    "3gp": (["-f", "3gp"], "video/3gpp"),
+    "mp4": (["-movflags", "+faststart", "-f", "mp4"], "video/mp4"),
+}
+
+# Форматы, которые ffmpeg умеет читать из пайпа без перемотки
+PIPE_FRIENDLY = {
+    "audio/ogg",
+    "audio/opus",
+    "audio/mpeg",
+    "audio/wav",
+    "audio/x-wav",
+    "audio/flac",
+    "audio/x-flac",
+    "audio/webm",
+}
+
+CHUNK_SIZE = 16 * 1024
+
+
+def audio_mime(fmt: str) -> str:
+    return AUDIO_FORMATS[fmt][1]
+
+
+def video_mime(fmt: str) -> str:
+    return VIDEO_FORMATS[fmt][1]
+
+
+def _audio_args(fmt: str, bitrate: str) -> List[str]:
+    codec, _ = AUDIO_FORMATS[fmt]
+    if fmt == "amr":
+        # AMR-NB поддерживает только фиксированные битрейты
+        bitrate = "12.2k"
+    return [*codec, "-b:a", bitrate, "-f", fmt]
+
+
+async def _feed(proc: asyncio.subprocess.Process, chunks: AsyncIterator[bytes]):
+    try:
+        async for chunk in chunks:
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        with contextlib.suppress(Exception):
+            proc.stdin.close()
+
+
+async def _transcode_audio(
+    source: Union[str, AsyncIterator[bytes]],
+    part: str,
+    file: str,
+    fmt: str,
+    bitrate: str,
+    slot: Optional[AsyncContextManager] = None,
+    written: Optional[asyncio.Event] = None,
+) -> bool:
+    """Пишет результат ffmpeg в `part` и по успеху переименовывает в `file`.
+
+    `slot` занимается только на время работы ffmpeg, `written` отмечает
+    каждую запись (и завершение) для читающего файл следом.
+    """
+    piped = not isinstance(source, str)
+    async with contextlib.AsyncExitStack() as stack:
+        if slot is not None:
+            await stack.enter_async_context(slot)
+        # только работа ffmpeg, без ожидания слота и темпа клиента
+        stack.enter_context(metrics.transcode_duration.time("audio"))
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-i",
+            "pipe:0" if piped else source,
+            "-vn",
+            *_audio_args(fmt, bitrate),
+            "pipe:1",
+            stdin=asyncio.subprocess.PIPE if piped else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        feeder = asyncio.ensure_future(_feed(proc, source)) if piped else None
+        done = False
+        try:
+            with open(part, "ab") as f:
+                while chunk := await proc.stdout.read(CHUNK_SIZE):
+                    f.write(chunk)
+                    f.flush()
+                    if written is not None:
+                        written.set()
+            if feeder:
+                await feeder
+            done = await proc.wait() == 0
+        finally:
+            if feeder and not feeder.done():
+                feeder.cancel()
+            if proc.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    proc.kill()
+                await proc.wait()
+            # открытый читателем файл переживает переименование
+            if done:
+                os.replace(part, file)
+            else:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(part)
+            if not piped:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(source)
+            if written is not None:
+                written.set()
+    return done
+
+
+async def stream_audio(
+    source: Union[str, AsyncIterator[bytes]],
+    file: str,
+    fmt: str = "mp3",
+    bitrate: str = "32k",
+    slot: Optional[AsyncContextManager] = None,
+) -> AsyncIterator[bytes]:
+    """Перекодирует аудио через ffmpeg и отдаёт результат по кускам.
+
+    ffmpeg в своём темпе пишет во временный `.part` (переименовывается в
+    `file` после успешного завершения), а клиенту отдаётся файл по мере
+    записи - медленный клиент не держит ни ffmpeg, ни `slot` очереди.
+    `source` - путь к файлу или асинхронный итератор байтов (например,
+    `client.iter_download`). Исходный файл удаляется после перекодирования.
+    """
+    # у каждого потока свой .part: одновременные загрузки не мешают друг другу
+    part = f"{file}.{secrets.token_hex(4)}.part"
+    open(part, "wb").close()
+    written = asyncio.Event()
+    producer = asyncio.ensure_future(
+        _transcode_audio(source, part, file, fmt, bitrate, slot, written)
+    )
+    try:
+        with open(part, "rb") as f:
+            while True:
+                # событие сбрасывается до чтения, чтобы не пропустить запись
+                written.clear()
+                finished = producer.done()
+                if chunk := f.read(CHUNK_SIZE):
+                    yield chunk
+                elif finished:
+                    break
+                else:
+                    await written.wait()
+        await producer
+    finally:
+        # клиент ушёл раньше - перекодирование не доводим
+        if not producer.done():
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+
+
+async def transcode_audio(
+    source: Union[str, AsyncIterator[bytes]],
+    file: str,
+    fmt: str = "mp3",
+    bitrate: str = "32k",
+) -> str:
+    """То же, что `stream_audio`, но только пишет результат в кеш."""
+    part = f"{file}.{secrets.token_hex(4)}.part"
+    if not await _transcode_audio(source, part, file, fmt, bitrate):
+        raise RuntimeError("ffmpeg не смог перекодировать аудио")
+    return file
+
+
+##### / Сжатие видео / #####
+async def transcode_video(
+    source: str,
+    file: str,
+    fmt: str = "3gp",
+    max_size: int = 176,
+    bitrate: str = "96k",
+    fps: int = 15,
+    duration: Optional[float] = None,
+    on_progress: Optional[Callable[[float], None]] = None,
+) -> str:
+    """Ужимает видео под кнопочный телефон, сообщая прогресс (0..1) в `on_progress`.
+
+    Результат пишется в `file.part` и переименовывается в `file` после
+    успешного завершения ffmpeg, исходный файл удаляется.
+    """
+    container, _ = VIDEO_FORMATS[fmt]
+    scale = (
+        f"scale={max_size}:{max_size}:force_original_aspect_ratio=decrease,"
+        "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+    )
+    part = f"{file}.part"
+    done = False
+    proc = None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-nostats",
+            "-y",
+            "-i",
+            source,
+            "-vf",
+            scale,
+            "-r",
+            str(fps),
+            "-c:v",
+            "mpeg4",
+            "-b:v",
+            bitrate,
+            "-c:a",
+            "aac",
+            "-ac",
+            "1",
+            "-ar",
+            "22050",
+            "-b:a",
+            "24k",
+            "-progress",
+            "pipe:1",
+            *container,
+            part,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        async for line in proc.stdout:
+            key, _, value = line.decode().strip().partition("=")
+            if key == "out_time_us" and duration and on_progress and value.isdigit():
+                on_progress(min(int(value) / 1e6 / duration, 1.0))
+        if await proc.wait() != 0:
+            raise RuntimeError("ffmpeg не смог сжать видео")
+        os.replace(part, file)
+        done = True
+        return file
+    finally:
+        # при отмене задачи ffmpeg не должен остаться писать в .part
+        if proc is not None and proc.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+            await proc.wait()
+        if not done:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(part)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(source)
+
+
+##### / Кадр из видео / #####
+async def first_frame(source: str) -> bytes:
+    """Первый кадр видео (видеостикера) в PNG, исходный файл удаляется"""
+    try:
+        # libvpx сохраняет прозрачность VP9, встроенный декодер - нет
+        for decoder in (["-c:v", "libvpx-vp9"], []):
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg",
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                *decoder,
+                "-i",
+                source,
+                "-frames:v",
+                "1",
+                "-f",
+                "image2pipe",
+                "-c:v",
+                "png",
+                "-",
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+            )
+            data, _ = await proc.communicate()
+            if proc.returncode == 0 and data:
+                return data
+        raise RuntimeError("ffmpeg не смог достать кадр")
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(source)
@@ -0,0 +1,51 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tapkofon"))
+
+import api  # noqa: E402
+import models  # noqa: E402
+
+
+def test_parse_fields_builds_a_tree():
+    assert api.parse_fields("id, text,sender.id,sender.title") == {
+        "id": {},
+        "text": {},
+        "sender": {"id": {}, "title": {}},
+    }
+    assert api.parse_fields("") is None
+    assert api.parse_fields(" , .") is None
+
+
+def test_select_keeps_requested_fields_only():
+    data = [
+        {"id": 1, "text": "a", "sender": {"id": 7, "title": "t"}},
+        {"id": 2, "sender": {"id": 8}},
+    ]
+    tree = api.parse_fields("id,sender.id,missing")
+
+    assert api.select(data, tree) == [
+        {"id": 1, "sender": {"id": 7}},
+        {"id": 2, "sender": {"id": 8}},
+    ]
+    assert api.select(data, None) is data
+
+
+def test_wants_top_level_field():
+    assert api.wants(None, "about")
+    assert api.wants(api.parse_fields("about.bio"), "about")
+    assert not api.wants(api.parse_fields("id"), "about")
+
+
+def test_page_drops_none_and_keeps_cursor():
+    items = [models.Peer(id=1, title="a"), models.Peer(id=2)]
+    response = api.page(items, "2", api.parse_fields("id,title"))
+
+    assert json.loads(response.body) == {
+        "items": [{"id": 1, "title": "a"}, {"id": 2}],
+        "next": "2",
+    }
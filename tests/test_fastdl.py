@@ -0,0 +1,93 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tapkofon"))
+
+import fastdl  # noqa: E402
+
+DATA = bytes(range(256)) * 4 + b"tail"
+
+
+class Sender:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.parts = []
+        self.closed = False
+
+    async def disconnect(self):
+        self.closed = True
+
+
+class Client:
+    """upload.getFile по `DATA` с задержкой, чтобы части шли вперемешку"""
+
+    async def _call(self, sender, request):
+        await asyncio.sleep(0.001 * (len(sender.parts) % 3))
+        if sender.fail:
+            raise ConnectionError("обрыв")
+        sender.parts.append(request.offset)
+        return SimpleNamespace(
+            bytes=DATA[request.offset : request.offset + request.limit]
+        )
+
+
+class Downloader(fastdl.Downloader):
+    def __init__(self, senders, broken=()):
+        super().__init__(Client(), None, connections=len(senders), part_size=100)
+        self.senders = senders
+        self.broken = broken
+
+    async def _key(self, dc_id):
+        return None, None
+
+    async def _sender(self, dc_id, key):
+        sender = self.senders.pop(0)
+        if sender in self.broken:
+            raise ConnectionError("не подключиться")
+        return sender
+
+
+def test_parts_are_shared_between_connections(tmp_path):
+    senders = [Sender() for _ in range(3)]
+    progress = []
+    file = str(tmp_path / "file")
+    downloader = Downloader(list(senders))
+    asyncio.run(
+        downloader._download(2, None, len(DATA), file, lambda d, t: progress.append(d))
+    )
+
+    assert Path(file).read_bytes() == DATA
+    offsets = sorted(o for s in senders for o in s.parts)
+    assert offsets == list(range(0, len(DATA), 100))
+    assert all(s.parts for s in senders)
+    assert progress[-1] == len(DATA)
+    assert all(s.closed for s in senders)
+    assert os.listdir(tmp_path) == ["file"]
+
+
+def test_failed_part_leaves_no_file(tmp_path):
+    senders = [Sender(), Sender(fail=True)]
+    file = str(tmp_path / "file")
+    with pytest.raises(ConnectionError):
+        asyncio.run(Downloader(list(senders))._download(2, None, len(DATA), file, None))
+
+    assert os.listdir(tmp_path) == []
+    assert all(s.closed for s in senders)
+
+
+def test_failed_connect_closes_connected_senders(tmp_path):
+    senders = [Sender(), Sender(), Sender()]
+    downloader = Downloader(list(senders), broken=(senders[1],))
+    with pytest.raises(ConnectionError):
+        asyncio.run(downloader._download(2, None, len(DATA), str(tmp_path / "f"), None))
+
+    assert [s.closed for s in senders] == [True, False, True]
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,81 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tapkofon"))
+
+import jobs  # noqa: E402
+
+
+def test_bump_moves_a_waiter_ahead():
+    order = []
+
+    async def run():
+        slots = jobs._Slots(1)
+        await slots.acquire(jobs.Priority.INTERACTIVE)
+        waiting = {}
+
+        async def wait(name, priority):
+            job = waiting[name] = jobs.Job("audio", name, priority, {})
+            await slots.acquire(priority, job)
+            order.append(name)
+            slots.release()
+
+        tasks = [
+            asyncio.ensure_future(wait("a", jobs.Priority.PREFETCH)),
+            asyncio.ensure_future(wait("b", jobs.Priority.PREFETCH)),
+            asyncio.ensure_future(wait("c", jobs.Priority.RECOGNIZE)),
+        ]
+        await asyncio.sleep(0)
+        slots.bump(waiting["c"], jobs.Priority.INTERACTIVE)
+        slots.release()
+        await asyncio.gather(*tasks)
+        return slots.free
+
+    assert asyncio.run(run()) == 1
+    assert order == ["c", "a", "b"]
+
+
+def test_cancelled_waiter_does_not_lose_the_slot():
+    async def run():
+        slots = jobs._Slots(1)
+        await slots.acquire(jobs.Priority.INTERACTIVE)
+        waiter = asyncio.ensure_future(slots.acquire(jobs.Priority.PREFETCH))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        slots.release()
+        return slots.free
+
+    assert asyncio.run(run()) == 1
+
+
+def test_resubmit_raises_priority_of_a_queued_job(tmp_path):
+    order = []
+
+    async def run():
+        queue = jobs.JobQueue(tmp_path / "jobs.json", workers=1)
+        gate = asyncio.Event()
+
+        async def handler(job):
+            if job.key == "busy":
+                await gate.wait()
+            order.append(job.key)
+
+        queue.register("audio", handler)
+        busy = queue.submit("audio", "busy")
+        queue.submit("audio", "prefetch", jobs.Priority.PREFETCH)
+        late = queue.submit("audio", "late", jobs.Priority.RECOGNIZE)
+        await asyncio.sleep(0.01)
+        # страница запросила то же самое - задача обгоняет предзагрузку
+        assert queue.submit("audio", "late") is late
+        gate.set()
+        for job in list(queue.jobs.values()):
+            await queue.wait(job, 1)
+        return busy.state
+
+    assert asyncio.run(run()) == "done"
+    assert order == ["busy", "late", "prefetch"]
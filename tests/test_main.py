@@ -0,0 +1,263 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import datetime
+import json
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+APP = Path(__file__).resolve().parent.parent / "tapkofon"
+sys.path.insert(0, str(APP))
+
+import store  # noqa: E402
+
+
+def import_main(tmp_path, monkeypatch):
+    # конфиг читается из ../session относительно каталога приложения
+    (tmp_path / "session").mkdir(exist_ok=True)
+    (tmp_path / "app").mkdir(exist_ok=True)
+    if not (tmp_path / "app" / "templates").exists():
+        (tmp_path / "app" / "templates").symlink_to(APP / "templates")
+    monkeypatch.chdir(tmp_path / "app")
+    import main
+
+    return main
+
+
+def dialog(id, date, pinned=False, unread=0):
+    return SimpleNamespace(
+        id=id,
+        date=datetime.datetime.fromtimestamp(date, datetime.timezone.utc),
+        message=SimpleNamespace(id=id * 10),
+        pinned=pinned,
+        unread_count=unread,
+        unread_mentions_count=0,
+        is_user=True,
+        is_group=False,
+    )
+
+
+class Dialogs:
+    """get_dialogs как у Telegram: закреплённые в начале каждой пачки"""
+
+    def __init__(self, dialogs):
+        self.dialogs = dialogs
+        self.calls = 0
+
+    async def get_dialogs(self, limit, archived, offset_date=None, **offset):
+        self.calls += 1
+        pinned = [d for d in self.dialogs if d.pinned]
+        rest = [d for d in self.dialogs if not d.pinned]
+        if offset_date:
+            bound = (offset_date, offset["offset_id"], offset["offset_peer"])
+            rest = [d for d in rest if (d.date, d.message.id, d.id) < bound]
+        return (pinned + rest)[:limit]
+
+
+def pages(main, **filters):
+    async def run():
+        result, cursor = [], None
+        while True:
+            chats, cursor = await main._dialogs_page(cursor, archived=False, **filters)
+            result.append([d.id for d in chats])
+            if cursor is None:
+                return result
+
+    return asyncio.run(run())
+
+
+def test_dialogs_pages_show_pinned_once(tmp_path, monkeypatch):
+    main = import_main(tmp_path, monkeypatch)
+    dialogs = [dialog(1, 50, pinned=True)] + [dialog(i, 100 - i) for i in range(2, 8)]
+    monkeypatch.setattr(main, "scheduler", Dialogs(dialogs))
+    monkeypatch.setattr(main.config, "dialogs_page_size", 3)
+
+    assert pages(main, unread=False, kind=None) == [[1, 2, 3], [4, 5, 6], [7]]
+
+
+def test_dialogs_filter_stops_at_scan_limit(tmp_path, monkeypatch):
+    main = import_main(tmp_path, monkeypatch)
+    dialogs = [dialog(i, 1000 - i, unread=int(i % 50 == 0)) for i in range(1, 251)]
+    scheduler = Dialogs(dialogs)
+    monkeypatch.setattr(main, "scheduler", scheduler)
+    monkeypatch.setattr(main.config, "dialogs_page_size", 3)
+    monkeypatch.setattr(main.config, "dialogs_scan_limit", 100)
+
+    # за раз просматривается не больше 100 диалогов, курсор ведёт дальше
+    assert pages(main, unread=True, kind=None) == [[50, 100], [150, 200], [250]]
+    assert scheduler.calls == 3
+
+
+class Calls:
+    """Записывает вызовы методов клиента и хранилища"""
+
+    def __init__(self):
+        self.calls = []
+
+    def is_connected(self):
+        return True
+
+    async def is_user_authorized(self):
+        return True
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+
+        return call
+
+
+def bulk(main, monkeypatch, action, ids):
+    async def open_chat(id):
+        return store.StoredChat(id=id)
+
+    client, history = Calls(), Calls()
+    monkeypatch.setattr(main, "user", client)
+    monkeypatch.setattr(main, "history", history)
+    monkeypatch.setattr(main, "_open_chat", open_chat)
+    monkeypatch.setattr(main, "_dialogs_changed", lambda: None)
+    page = asyncio.run(main.bulk_messages("5", action=action, ids=ids))
+    return page, client.calls, history.calls
+
+
+def test_bulk_delete_is_one_call(tmp_path, monkeypatch):
+    main = import_main(tmp_path, monkeypatch)
+    page, client, history = bulk(main, monkeypatch, "delete", [7, 3, 7, 5])
+
+    assert client == [("delete_messages", (5, [3, 5, 7]), {})]
+    assert history == [("delete", (5, [3, 5, 7]), {})]
+    assert "Удалено сообщений: 3" in page
+
+
+def test_bulk_read_acknowledges_up_to_the_newest(tmp_path, monkeypatch):
+    main = import_main(tmp_path, monkeypatch)
+    _, client, _ = bulk(main, monkeypatch, "read", [4, 9, 2])
+
+    assert client == [("send_read_acknowledge", (5,), {"max_id": 9})]
+
+
+def test_bulk_rejects_unknown_action(tmp_path, monkeypatch):
+    main = import_main(tmp_path, monkeypatch)
+    page, client, history = bulk(main, monkeypatch, "pin", [1])
+
+    assert (client, history) == ([], [])
+    assert "Неизвестное действие" in page
+
+
+def test_api_messages_cursor_walks_the_store(tmp_path, monkeypatch):
+    main = import_main(tmp_path, monkeypatch)
+    history = store.MessageStore(tmp_path / "store.db")
+    chat = store.StoredChat(id=5, low=1, high=5, complete=True)
+
+    async def open_chat(id):
+        return chat
+
+    async def refresh(chat, enough):
+        return chat
+
+    monkeypatch.setattr(main, "user", Calls())
+    monkeypatch.setattr(main, "history", history)
+    monkeypatch.setattr(main, "_open_chat", open_chat)
+    monkeypatch.setattr(main, "_refresh", refresh)
+
+    async def run():
+        await history.put(
+            [store.StoredMessage(chat=5, id=i, date=i) for i in range(1, 6)]
+        )
+        result, cursor = [], None
+        while True:
+            response = await main.api_messages("5", cursor=cursor, limit=2, fields="id")
+            body = json.loads(response.body)
+            result.append([m["id"] for m in body["items"]])
+            if body["next"] is None:
+                break
+            cursor = int(body["next"])
+        await history.close()
+        return result
+
+    assert asyncio.run(run()) == [[5, 4], [3, 2], [1]]
+
+
+def speech(tmp_path, *parts):
+    """wav из тонов (речь) и тишины, длительности в секундах"""
+    from pydub import AudioSegment
+    from pydub.generators import Sine
+
+    audio = AudioSegment.empty()
+    for i, seconds in enumerate(parts):
+        if i % 2:
+            audio += AudioSegment.silent(seconds * 1000, frame_rate=16000)
+        else:
+            audio += Sine(440).to_audio_segment(seconds * 1000, volume=-10)
+    file = str(tmp_path / "speech.wav")
+    audio.set_frame_rate(16000).export(file, format="wav")
+    return file
+
+
+def chunk_seconds(chunks):
+    return [
+        round(len(c.frame_data) / c.sample_rate / c.sample_width, 1) for c in chunks
+    ]
+
+
+def test_recognize_chunks_split_on_pauses(tmp_path, monkeypatch):
+    main = import_main(tmp_path, monkeypatch)
+    file = speech(tmp_path, 3, 1, 3, 1, 3)
+
+    monkeypatch.setattr(main.config, "recognize_chunk_s", 5)
+    # каждый кусок - фраза и по 0.2 с запаса вокруг неё
+    assert chunk_seconds(main._recognize_chunks(file)) == [3.2, 3.4, 3.2]
+    monkeypatch.setattr(main.config, "recognize_chunk_s", 8)
+    # соседние фразы склеиваются, пока кусок не длиннее лимита
+    assert chunk_seconds(main._recognize_chunks(file)) == [7.2, 3.2]
+
+
+def test_recognize_chunks_cut_long_speech(tmp_path, monkeypatch):
+    main = import_main(tmp_path, monkeypatch)
+    monkeypatch.setattr(main.config, "recognize_chunk_s", 5)
+
+    assert chunk_seconds(main._recognize_chunks(speech(tmp_path, 12))) == [
+        5.2,
+        5.4,
+        2.2,
+    ]
+
+
+class RecognizeJob:
+    progress = 0.0
+
+    def __init__(self):
+        self.partials = []
+
+    @property
+    def partial(self):
+        return self.partials[-1] if self.partials else None
+
+    @partial.setter
+    def partial(self, value):
+        self.partials.append(value)
+
+
+def test_recognize_file_shows_only_the_ready_prefix(tmp_path, monkeypatch):
+    main = import_main(tmp_path, monkeypatch)
+
+    def recognize(chunk):
+        if chunk == "bad":
+            raise ConnectionError("нет связи")
+        if chunk == "раз":
+            time.sleep(0.1)
+        return chunk
+
+    monkeypatch.setattr(main, "_recognize_chunks", lambda file: ["раз", "bad", "три"])
+    monkeypatch.setattr(main, "_recognize_chunk", recognize)
+    monkeypatch.setattr(main.config, "recognize_workers", 3)
+    job = RecognizeJob()
+
+    text = asyncio.run(main._recognize_file(job, "speech.wav"))
+    assert text == "раз […] три"
+    # пока первый кусок не готов, промежуточного текста нет
+    assert job.partials == ["", "", "раз […] три"]
+    assert job.progress == 1.0
@@ -0,0 +1,58 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tapkofon"))
+
+import mediacache  # noqa: E402
+
+
+def entry(size):
+    return mediacache.HotEntry(None, "image/jpeg", b"x" * size)
+
+
+def test_second_disk_read_promotes():
+    hot = mediacache.HotCache(100, 50)
+
+    assert not hot.seen("a")
+    assert hot.seen("a")
+    # после продвижения счёт начинается заново
+    assert not hot.seen("a")
+
+
+def test_eviction_is_lru_by_size():
+    hot = mediacache.HotCache(100, 50)
+    for key in "abc":
+        assert hot.put(key, entry(40))
+
+    assert len(hot) == 2 and hot.size == 80
+    assert hot.get("a") is None
+    hot.get("b")
+    hot.put("d", entry(40))
+    assert hot.get("b") is not None
+    assert hot.get("c") is None
+    assert (hot.hits, hot.misses) == (2, 2)
+
+
+def test_large_and_empty_items_are_not_kept():
+    hot = mediacache.HotCache(100, 50)
+
+    assert not hot.put("big", entry(51))
+    assert not hot.put("empty", entry(0))
+    assert len(hot) == 0
+    # max_item не больше всего объёма
+    assert mediacache.HotCache(10, 50).max_item == 10
+
+
+def test_replace_and_drop_prefix_keep_size():
+    hot = mediacache.HotCache(100, 50)
+    hot.put("cache/1/10", entry(30))
+    hot.put("cache/1/10", entry(20))
+    hot.put("cache/1/11", entry(10))
+    hot.put("cache/12/1", entry(10))
+
+    assert hot.size == 40
+    hot.drop_prefix("cache/1/")
+    assert hot.size == 10 and len(hot) == 1
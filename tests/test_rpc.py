@@ -0,0 +1,35 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tapkofon"))
+
+import rpc  # noqa: E402
+
+
+def test_unlisted_class_uses_other_limits():
+    scheduler = rpc.Scheduler(None, {"messages": (5, 10), "other": (2, 3)})
+
+    async def call():
+        return await scheduler.call("unlisted", None, lambda: asyncio.sleep(0, "ok"))
+
+    assert asyncio.run(call()) == "ok"
+    bucket = scheduler.buckets["unlisted"]
+    assert (bucket.rate, bucket.burst) == (2, 3)
+    assert bucket is not scheduler.buckets["other"]
+
+
+def test_flood_threshold_only_inside_scheduler():
+    scheduler = rpc.Scheduler(None, {}, flood_sleep_threshold=0)
+
+    async def threshold():
+        return rpc.flood_threshold()
+
+    async def call():
+        inside = await scheduler.call("messages", None, threshold)
+        return inside, await threshold()
+
+    assert asyncio.run(call()) == (0, None)
@@ -0,0 +1,143 @@
+# Copyright 2022 d4n13l3k00.
+# SPDX-License-Identifier: 	AGPL-3.0-or-later
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tapkofon"))
+
+import store  # noqa: E402
+
+CHAT = 42
+
+
+def message(id, text=None, date=None, chat=CHAT):
+    return store.StoredMessage(
+        chat=chat, id=id, raw_text=text, text=text, date=date or 1000 + id
+    )
+
+
+def test_page_reads_only_the_covered_range(tmp_path):
+    history = store.MessageStore(tmp_path / "store.db")
+
+    async def run():
+        await history.put([message(i) for i in range(1, 11)])
+        chat = store.StoredChat(id=CHAT, low=3, high=7)
+        await history.save_chat(chat)
+        page = await history.page(chat, 10)
+        count = await history.count(chat)
+        uncovered = await history.page(store.StoredChat(id=CHAT), 10)
+        await history.close()
+        return [m.id for m in page], count, uncovered
+
+    assert asyncio.run(run()) == ([7, 6, 5, 4, 3], 5, [])
+
+
+def test_live_message_extends_only_live_chats(tmp_path):
+    history = store.MessageStore(tmp_path / "store.db")
+
+    async def run():
+        await history.save_chat(store.StoredChat(id=CHAT, low=1, high=5, live=True))
+        await history.save_chat(store.StoredChat(id=7, low=1, high=5))
+        await history.live_message(message(6))
+        await history.live_message(message(6, chat=7))
+        live, stale = await history.chat(CHAT), await history.chat(7)
+        await history.close()
+        return live.high, stale.high
+
+    # у несверенного чата между high и новым сообщением может быть пропуск
+    assert asyncio.run(run()) == (6, 5)
+
+
+def test_sync_replaces_the_range(tmp_path):
+    history = store.MessageStore(tmp_path / "store.db")
+
+    async def run():
+        await history.put([message(i) for i in range(1, 6)])
+        # 3 удалено в Telegram, пока клиент был не на связи
+        await history.sync(CHAT, 2, 4, [message(2), message(4, "edited")])
+        chat = store.StoredChat(id=CHAT, low=1, high=5)
+        rows = await history.page(chat, 10)
+        await history.close()
+        return [(m.id, m.raw_text) for m in rows]
+
+    assert asyncio.run(run()) == [(5, None), (4, "edited"), (2, None), (1, None)]
+
+
+def test_version_follows_messages_not_save_chat(tmp_path):
+    history = store.MessageStore(tmp_path / "store.db")
+
+    async def run():
+        await history.save_chat(store.StoredChat(id=CHAT, low=1, high=1))
+        before = (await history.chat(CHAT)).version
+        await history.put([message(1)])
+        await history.delete(CHAT, [1])
+        # сохранение чата с устаревшей версией её не откатывает
+        await history.save_chat(store.StoredChat(id=CHAT, low=1, high=1))
+        after = (await history.chat(CHAT)).version
+        await history.close()
+        return before, after
+
+    assert asyncio.run(run()) == (0, 2)
+
+
+def test_fts_follows_insert_replace_and_delete(tmp_path):
+    history = store.MessageStore(tmp_path / "store.db")
+
+    async def run():
+        await history.save_chat(store.StoredChat(id=CHAT, low=1, high=10))
+        await history.put([message(1, "привет мир"), message(2, "другое")])
+        found = [[m.id for m in await history.search(q)] for q in ("мир", "прив")]
+        # правка приходит как INSERT OR REPLACE
+        await history.put([message(1, "пока")])
+        edited = [[m.id for m in await history.search(q)] for q in ("мир", "пока")]
+        await history.delete(CHAT, [1])
+        deleted = [m.id for m in await history.search("пока")]
+        await history.close()
+        return found, edited, deleted
+
+    assert asyncio.run(run()) == ([[1], [1]], [[], [1]], [])
+
+
+def test_search_skips_uncovered_messages(tmp_path):
+    history = store.MessageStore(tmp_path / "store.db")
+
+    async def run():
+        await history.save_chat(store.StoredChat(id=CHAT, low=5, high=10))
+        await history.put([message(3, "кот"), message(6, "кот")])
+        result = [m.id for m in await history.search("кот")]
+        await history.close()
+        return result
+
+    assert asyncio.run(run()) == [6]
+
+
+def test_search_cursor_pages_without_gaps(tmp_path):
+    history = store.MessageStore(tmp_path / "store.db")
+
+    async def run():
+        await history.save_chat(store.StoredChat(id=1, low=1, high=10))
+        await history.save_chat(store.StoredChat(id=2, low=1, high=10))
+        # одинаковые даты в разных чатах: порядок задаёт (date, chat, id)
+        await history.put(
+            [message(i, "кот", date=100 + i // 2, chat=1 + i % 2) for i in range(1, 8)]
+        )
+        pages, before = [], None
+        while rows := await history.search("кот", before=before, limit=3):
+            pages.append([(m.chat, m.id) for m in rows])
+            last = rows[-1]
+            before = (last.date, last.chat, last.id)
+        await history.close()
+        return pages
+
+    pages = asyncio.run(run())
+    flat = [key for page in pages for key in page]
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert sorted(flat) == sorted((1 + i % 2, i) for i in range(1, 8))
+    assert flat[0] == (2, 7)
+
+
+def test_fts_query_quotes_words():
+    assert store.fts_query('кот "мяу') == '"кот"* """мяу"*'
+    assert store.fts_query("   ") == '""'